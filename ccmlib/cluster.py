@@ -3,16 +3,147 @@
 from six import print_, iteritems
 from six.moves import xrange
 
-import yaml
 import os
 import re
 import subprocess
 import shutil
+import sys
+import threading
 import time
-
-from ccmlib import common, repository
-from ccmlib.node import Node, NodeError
-from ccmlib.bulkloader import BulkLoader
+from contextlib import contextmanager
+
+from ccmlib import common
+from ccmlib.node import Node, NodeError, TimeoutError, STOP_TIMEOUT
+from ccmlib.log_bus import LogBus
+from ccmlib.log_search import grep_log_lines, rotated_logs
+
+# Maximum number of nodes worked on concurrently by cluster-wide operations
+FAN_OUT_WORKERS = 16
+# total size of the logs under which grep_log searches them in process
+PARALLEL_GREP_MIN_SIZE = 32 * 1024 * 1024
+
+def _merge_names(on_disk, ours, known):
+    # Merge a list of names (nodes, seeds) as found on disk, possibly updated
+    # by another process, with ours: we only apply the additions and removals
+    # made since we last read or wrote it (known)
+    removed = set(known) - set(ours)
+    merged = [ name for name in on_disk if name not in removed ]
+    return merged + [ name for name in ours if name not in known and name not in merged ]
+
+def _merge_node_config(values, on_disk, status_changed):
+    # Unless we changed it, keep the status recorded on disk, which may have
+    # been updated by another process (starting or stopping the node)
+    if status_changed or on_disk is None:
+        return values
+    merged = dict(values)
+    for key in [ 'status', 'pid', 'pid_start_time' ]:
+        if key in on_disk:
+            merged[key] = on_disk[key]
+        else:
+            merged.pop(key, None)
+    return merged
+
+class _LazyNodes(dict):
+    """
+    The nodes of a lazily loaded cluster: the names are known upfront but a
+    node is only loaded from its node.conf when it is first accessed.
+    """
+
+    def __init__(self, loader, names):
+        dict.__init__(self, [ (name, None) for name in names ])
+        self.__loader = loader
+        self.__pending = set(names)
+
+    def __load(self, name):
+        if name in self.__pending:
+            dict.__setitem__(self, name, self.__loader(name))
+            self.__pending.discard(name)
+
+    def __load_all(self):
+        for name in list(self.__pending):
+            self.__load(name)
+
+    def __getitem__(self, name):
+        self.__load(name)
+        return dict.__getitem__(self, name)
+
+    def __setitem__(self, name, node):
+        self.__pending.discard(name)
+        dict.__setitem__(self, name, node)
+
+    def __delitem__(self, name):
+        self.__pending.discard(name)
+        dict.__delitem__(self, name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def pop(self, name, *default):
+        self.__load(name)
+        self.__pending.discard(name)
+        return dict.pop(self, name, *default)
+
+    def values(self):
+        self.__load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.__load_all()
+        return dict.items(self)
+
+    def itervalues(self):
+        self.__load_all()
+        return iter(dict.values(self))
+
+    def iteritems(self):
+        self.__load_all()
+        return iter(dict.items(self))
+
+class _LazySeeds(list):
+    """
+    The seeds of a lazily loaded cluster: a list of node names that gets
+    resolved to the actual nodes on first use.
+    """
+
+    def __init__(self, nodes, names):
+        list.__init__(self, names)
+        self.__nodes = nodes
+        self.__resolved = False
+
+    def __resolve(self):
+        if not self.__resolved:
+            self.__resolved = True
+            # seeds removed from the cluster before being resolved are dropped
+            names = [ name for name in list.__iter__(self) if name in self.__nodes ]
+            list.__setitem__(self, slice(None), [ self.__nodes[name] for name in names ])
+
+    def __iter__(self):
+        self.__resolve()
+        return list.__iter__(self)
+
+    def __contains__(self, node):
+        self.__resolve()
+        return list.__contains__(self, node)
+
+    def __getitem__(self, index):
+        self.__resolve()
+        return list.__getitem__(self, index)
+
+    def __repr__(self):
+        self.__resolve()
+        return list.__repr__(self)
+
+    def append(self, node):
+        self.__resolve()
+        list.append(self, node)
+
+    def remove(self, node):
+        self.__resolve()
+        list.remove(self, node)
+
+    def index(self, node, *args):
+        self.__resolve()
+        return list.index(self, node, *args)
 
 class Cluster():
     def __init__(self, path, name, partitioner=None, cassandra_dir=None, create_directory=True, cassandra_version=None, verbose=False):
@@ -24,6 +155,29 @@ class Cluster():
         self.__log_level = "INFO"
         self.__path = path
         self.__version = None
+        self.__lazy = False
+        self.__lazy_lock = threading.Lock()
+        self.__log_bus = None
+        # the content of the state file, if this cluster uses one
+        self.__state = None
+        self.__state_lock = threading.Lock()
+        # writes deferred by batch()
+        self.__batch_depth = 0
+        self.__pending_nodes = {}
+        # the nodes and seeds as last read or written, to merge the updates
+        # made by other processes
+        self.__known_nodes = []
+        # the nodes of the cluster as last written, with the ones added by
+        # other processes
+        self.__written_nodes = []
+        self.__known_seeds = []
+        self.__pending_cluster = False
+        self.__pending_topology = False
+        # the nodes removed from this cluster, whose configuration must not
+        # be saved anymore
+        self.__removed_nodes = []
+        if create_directory and common.use_state_file(path):
+            self.__state = { 'cluster' : {}, 'nodes' : {} }
         if create_directory:
             # we create the dir before potentially downloading to throw an error sooner if need be
             os.mkdir(self.get_path())
@@ -39,6 +193,7 @@ class Cluster():
                         self.__cassandra_dir = os.path.abspath(cassandra_dir)
                     self.__version = self.__get_version_from_build()
             else:
+                from ccmlib import repository
                 dir, v = repository.setup(cassandra_version, verbose)
                 self.__cassandra_dir = dir
                 self.__version = v if v is not None else self.__get_version_from_build()
@@ -59,15 +214,17 @@ class Cluster():
     def set_cassandra_dir(self, cassandra_dir=None, cassandra_version=None, verbose=False):
         if cassandra_version is None:
             self.__cassandra_dir = cassandra_dir
+            self.__lazy = False
             common.validate_cassandra_dir(cassandra_dir)
             self.__version = self.__get_version_from_build()
         else:
+            from ccmlib import repository
             dir, v = repository.setup(cassandra_version, verbose)
             self.__cassandra_dir = dir
+            self.__lazy = False
             self.__version = v if v is not None else self.__get_version_from_build()
         self.__update_config()
-        for node in list(self.nodes.values()):
-            node.import_config_files()
+        self.__for_each_node(lambda node: node.import_config_files())
 
         # if any nodes have a data center, let's update the topology
         if any( [node.data_center for node in self.nodes.values()] ):
@@ -76,30 +233,87 @@ class Cluster():
         return self
 
     def get_cassandra_dir(self):
+        if self.__lazy:
+            self.__resolve_lazy()
         common.validate_cassandra_dir(self.__cassandra_dir)
         return self.__cassandra_dir
 
+    def __resolve_lazy(self):
+        # Lazily loaded cluster: validate the cassandra dir and read its
+        # version. Nodes may get there concurrently (see __for_each_node), and
+        # must not see the cluster as resolved before its version is known. If
+        # validation fails, the cluster stays lazy.
+        with self.__lazy_lock:
+            if not self.__lazy:
+                return
+            from ccmlib import repository
+            repository.validate(self.__cassandra_dir)
+            common.validate_cassandra_dir(self.__cassandra_dir)
+            self.__version = common.get_version_from_build(self.__cassandra_dir)
+            self.__lazy = False
+
+    def log_bus(self):
+        """
+        Returns the LogBus shared by all the users of this cluster object, to
+        wait on many log expressions of many nodes with a single background
+        reader per node log.
+        """
+        if self.__log_bus is None:
+            self.__log_bus = LogBus()
+        return self.__log_bus
+
     def nodelist(self):
         return [ self.nodes[name] for name in sorted(self.nodes.keys()) ]
 
     def version(self):
+        if self.__lazy:
+            self.__resolve_lazy()
         return self.__version
 
     @staticmethod
-    def load(path, name):
+    def load(path, name, lazy=False):
+        """
+        Load the cluster name from path. If lazy is True, nodes are only
+        loaded when first accessed and the cassandra directory of the cluster
+        is only validated (which may imply downloading or fetching it) when
+        it is actually needed.
+        """
         cluster_path = os.path.join(path, name)
-        filename = os.path.join(cluster_path, 'cluster.conf')
-        with open(filename, 'r') as f:
-            data = yaml.load(f)
+        state = None
+        filename = os.path.join(cluster_path, common.CLUSTER_STATE)
+        if not os.path.exists(filename):
+            filename = os.path.join(cluster_path, common.CLUSTER_CONF)
+            try:
+                with open(filename, 'r') as f:
+                    data = common.load_yaml(f)
+            except IOError:
+                # migrated to the state file in the meantime?
+                filename = os.path.join(cluster_path, common.CLUSTER_STATE)
+                if not os.path.exists(filename):
+                    raise
+        if filename.endswith(common.CLUSTER_STATE):
+            with open(filename, 'r') as f:
+                state = common.load_yaml(f)
         try:
+            if state is not None:
+                data = state['cluster']
             cassandra_dir = None
             if 'cassandra_dir' in data:
                 cassandra_dir = data['cassandra_dir']
-                repository.validate(cassandra_dir)
-
-            cluster = Cluster(path, data['name'], cassandra_dir=cassandra_dir, create_directory=False)
+                if not lazy:
+                    from ccmlib import repository
+                    repository.validate(cassandra_dir)
+
+            if lazy:
+                cluster = Cluster(path, data['name'], create_directory=False)
+                cluster.__cassandra_dir = cassandra_dir
+                cluster.__lazy = cassandra_dir is not None
+            else:
+                cluster = Cluster(path, data['name'], cassandra_dir=cassandra_dir, create_directory=False)
             node_list = data['nodes']
             seed_list = data['seeds']
+            cluster.__known_nodes = list(node_list)
+            cluster.__known_seeds = list(seed_list)
             if 'partitioner' in data:
                 cluster.partitioner = data['partitioner']
             if 'config_options' in data:
@@ -109,13 +323,205 @@ class Cluster():
         except KeyError as k:
             raise common.LoadError("Error Loading " + filename + ", missing property:" + k)
 
+        if state is not None:
+            cluster.__state = state
+        elif common.use_state_file(path):
+            cluster.__migrate_to_state_file()
+
+        load_node = lambda node_name: Node.load(cluster_path, node_name, cluster, cluster.__node_state(node_name))
+        if lazy:
+            cluster.nodes = _LazyNodes(load_node, node_list)
+            cluster.seeds = _LazySeeds(cluster.nodes, seed_list)
+            return cluster
+
         for node_name in node_list:
-            cluster.nodes[node_name] = Node.load(cluster_path, node_name, cluster)
+            cluster.nodes[node_name] = load_node(node_name)
         for seed_name in seed_list:
             cluster.seeds.append(cluster.nodes[seed_name])
 
         return cluster
 
+    @contextmanager
+    def batch(self):
+        """
+        Defers the writes of cluster.conf, node.conf (or the state file) and
+        cassandra-topology.properties until the end of the block, so that
+        each file is written once however many changes are made:
+
+            with cluster.batch():
+                cluster.add(node, True, 'dc1')
+                ...
+
+        Batches can be nested: writes happen when the outermost one ends.
+        """
+        self.__batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.__batch_depth -= 1
+            if self.__batch_depth == 0:
+                self.__flush_batch()
+
+    def _save_node_config(self, node, values, status_changed=True):
+        """
+        Persist the configuration of node (as written by Node). This is the
+        node.conf of the node, or its entry in the cluster state file. Unless
+        status_changed, the status already recorded is kept.
+        """
+        if self.__batch_depth > 0:
+            with self.__state_lock:
+                previous = self.__pending_nodes.get(node.name)
+                if previous is not None:
+                    status_changed = status_changed or previous[2]
+                self.__pending_nodes[node.name] = (node, values, status_changed)
+        else:
+            self.__write_configs(None, [ (node, values, status_changed) ])
+
+    def __flush_batch(self):
+        with self.__state_lock:
+            pending_nodes, self.__pending_nodes = list(self.__pending_nodes.values()), {}
+            pending_cluster, self.__pending_cluster = self.__pending_cluster, False
+            pending_topology, self.__pending_topology = self.__pending_topology, False
+        if pending_cluster or len(pending_nodes) > 0:
+            self.__write_configs(self.__config_values() if pending_cluster else None, pending_nodes)
+        if pending_topology:
+            self.__update_topology_files()
+
+    def __write_configs(self, cluster_values, node_values):
+        # Every write is a read-modify-write under a file lock (per node for
+        # node.conf, per cluster for cluster.conf or the state file), so that
+        # concurrent ccm commands on the same cluster don't lose updates
+        node_values = [ entry for entry in node_values if not any(entry[0] is node for node in self.__removed_nodes) ]
+        remaining = node_values
+        if self.__state is None:
+            remaining = self.__write_conf_files(cluster_values, node_values)
+        if remaining is not None:
+            filename = os.path.join(self.get_path(), common.CLUSTER_STATE)
+            with self.__state_lock, common.FileLock(filename):
+                state = self.__read_conf(filename) or self.__state
+                for node, values, status_changed in remaining:
+                    state['nodes'][node.name] = _merge_node_config(values, state['nodes'].get(node.name), status_changed)
+                if cluster_values is not None:
+                    # only drop the nodes we removed: the others may be
+                    # nodes being added by another process
+                    removed = set(self.__known_nodes) - set(self.nodes.keys())
+                    cluster_values = self.__merge_cluster_config(cluster_values, state['cluster'])
+                    state['cluster'] = cluster_values
+                    for node_name in removed:
+                        state['nodes'].pop(node_name, None)
+                self.__state = state
+                self.__write_state()
+
+        if cluster_values is not None:
+            # the registry only records the nodes: their status is refreshed
+            # by ccm list --status
+            common.update_registry(self.__path, self.name, self.__known_version(), node_names=self.__written_nodes)
+
+    def __write_conf_files(self, cluster_values, node_values):
+        # Writes the node.conf files, then cluster.conf. If another process
+        # migrated the cluster to the state file in the meantime, stops and
+        # returns what is left to write there (the state being loaded), or
+        # None once all is written.
+        state_filename = os.path.join(self.get_path(), common.CLUSTER_STATE)
+        for i, (node, values, status_changed) in enumerate(node_values):
+            filename = os.path.join(node.get_path(), common.NODE_CONF)
+            with common.FileLock(filename):
+                if os.path.exists(state_filename):
+                    self.__state = self.__read_conf(state_filename)
+                    return node_values[i:]
+                values = _merge_node_config(values, self.__read_conf(filename), status_changed)
+                common.write_file_atomically(filename, common.dump_yaml(values))
+        if cluster_values is not None:
+            filename = os.path.join(self.get_path(), common.CLUSTER_CONF)
+            with common.FileLock(filename):
+                if os.path.exists(state_filename):
+                    self.__state = self.__read_conf(state_filename)
+                    return []
+                cluster_values = self.__merge_cluster_config(cluster_values, self.__read_conf(filename))
+                common.write_file_atomically(filename, common.dump_yaml(cluster_values))
+        return None
+
+    def __read_conf(self, filename):
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as f:
+            return common.load_yaml(f)
+
+    def __merge_cluster_config(self, values, on_disk):
+        values = dict(values)
+        if on_disk is not None:
+            values['nodes'] = _merge_names(on_disk.get('nodes', []), values['nodes'], self.__known_nodes)
+            values['seeds'] = _merge_names(on_disk.get('seeds', []), values['seeds'], self.__known_seeds)
+        self.__known_nodes = list(self.nodes.keys())
+        self.__written_nodes = list(values['nodes'])
+        self.__known_seeds = [ node.name for node in self.seeds ]
+        return values
+
+    def _register(self, statuses=None):
+        """
+        Record this cluster, its nodes and their status (by default, the
+        current status of each node) in the registry of clusters.
+        """
+        if statuses is None:
+            statuses = dict([ (node.name, node.status) for node in list(self.nodes.values()) ])
+        common.update_registry(self.__path, self.name, self.__known_version(), statuses, list(self.nodes.keys()), create=True)
+
+    def __known_version(self):
+        # the version, without validating the cassandra dir of a lazily
+        # loaded cluster (which may imply fetching it)
+        if not self.__lazy:
+            return self.__version
+        try:
+            return common.get_version_from_build(self.__cassandra_dir)
+        except (common.CCMError, IOError, OSError):
+            return None
+
+    def __node_state(self, node_name):
+        if self.__state is None:
+            return None
+        try:
+            return self.__state['nodes'][node_name]
+        except KeyError:
+            raise common.LoadError("Error Loading " + os.path.join(self.get_path(), common.CLUSTER_STATE) + ", missing node: " + node_name)
+
+    def __write_state(self):
+        filename = os.path.join(self.get_path(), common.CLUSTER_STATE)
+        common.write_file_atomically(filename, common.dump_yaml(self.__state))
+
+    def __migrate_to_state_file(self):
+        # Gather cluster.conf and all the node.conf in the state file, which
+        # is written before the old files are removed: the state file always
+        # takes precedence when loading. All these files are locked for the
+        # migration, so that a concurrent write to one of them either comes
+        # first (and gets migrated) or finds the state file.
+        filename = os.path.join(self.get_path(), common.CLUSTER_STATE)
+        cluster_conf = os.path.join(self.get_path(), common.CLUSTER_CONF)
+        locks = [ common.FileLock(filename), common.FileLock(cluster_conf) ]
+        try:
+            for lock in locks:
+                lock.acquire()
+            if os.path.exists(filename):
+                # migrated by another process since we loaded the cluster
+                self.__state = self.__read_conf(filename)
+                return
+            data = self.__read_conf(cluster_conf)
+            state = { 'cluster' : data, 'nodes' : {} }
+            node_files = []
+            for node_name in data.get('nodes', []):
+                node_file = os.path.join(self.get_path(), node_name, common.NODE_CONF)
+                lock = common.FileLock(node_file)
+                lock.acquire()
+                locks.append(lock)
+                state['nodes'][node_name] = self.__read_conf(node_file)
+                node_files.append(node_file)
+            self.__state = state
+            self.__write_state()
+            for node_file in [ cluster_conf ] + node_files:
+                os.remove(node_file)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
     def add(self, node, is_seed, data_center=None):
         if node.name in self.nodes:
             raise common.ArgumentError('Cannot create existing node %s' % node.name)
@@ -158,31 +564,37 @@ class Cluster():
         if tokens is None and not use_vnodes:
             tokens = self.balanced_tokens(node_count)
 
-        for i in xrange(1, node_count + 1):
-            tk = None
-            if tokens is not None and i-1 < len(tokens):
-                tk = tokens[i-1]
-            dc = dcs[i-1] if i-1 < len(dcs) else None
-
-            node_ip = '%s%s' % (ipprefix, i)
-
-            if (iplist is not None):
-                node_ip = iplist[i-1]
-
-            binary = None
-            if self.version() >= '1.2':
-                binary = (node_ip, 9042)
-            node = Node('node%s' % i,
-                        self,
-                        False,
-                        (node_ip, 9160),
-                        (node_ip, 7000),
-                        str(7000 + i * 100),
-                        (str(0),  str(2000 + i * 100))[debug == True],
-                        tk,
-                        binary_interface=binary)
-            self.add(node, True, dc)
-            self.__update_config()
+        with self.batch():
+            template = None
+            for i in xrange(1, node_count + 1):
+                tk = None
+                if tokens is not None and i-1 < len(tokens):
+                    tk = tokens[i-1]
+                dc = dcs[i-1] if i-1 < len(dcs) else None
+
+                node_ip = '%s%s' % (ipprefix, i)
+
+                if (iplist is not None):
+                    node_ip = iplist[i-1]
+
+                binary = None
+                if self.version() >= '1.2':
+                    binary = (node_ip, 9042)
+                node_args = ('node%s' % i,
+                             False,
+                             (node_ip, 9160),
+                             (node_ip, 7000),
+                             str(7000 + i * 100),
+                             (str(0),  str(2000 + i * 100))[debug == True],
+                             tk)
+                # The first node is created from the cassandra directory, the
+                # others are cloned from it and only get their own settings patched
+                if template is None:
+                    node = Node(node_args[0], self, *node_args[1:], binary_interface=binary)
+                    template = node
+                else:
+                    node = template.clone(*node_args, binary_interface=binary)
+                self.add(node, True, dc)
         return self
 
     def balanced_tokens(self, node_count):
@@ -196,15 +608,19 @@ class Cluster():
             if not node.name in self.nodes:
                 return
 
+            # stopping the node records its status, so it's stopped while
+            # still part of the cluster
+            node.stop(gently=False)
+            self.__removed_nodes.append(node)
             del self.nodes[node.name]
             if node in self.seeds:
                 self.seeds.remove(node)
             self.__update_config()
-            node.stop(gently=False)
             shutil.rmtree(node.get_path())
         else:
             self.stop(gently=False)
             shutil.rmtree(self.get_path())
+            common.remove_from_registry(self.__path, self.name)
 
     def clear(self):
         self.stop()
@@ -221,6 +637,7 @@ class Cluster():
         if len(list(self.nodes.values())) == 0:
             print_("No node in this cluster yet")
             return
+        Node.refresh_status(list(self.nodes.values()))
         for node in list(self.nodes.values()):
             if (verbose):
                 node.show(show_cluster=False)
@@ -228,8 +645,17 @@ class Cluster():
             else:
                 node.show(only_status=True)
 
-    def start(self, no_wait=False, verbose=False, wait_for_binary_proto=False, jvm_args=[], profile_options=None):
+    def start(self, no_wait=False, verbose=False, wait_for_binary_proto=False, jvm_args=[], profile_options=None, parallel=False, max_workers=None, timeout=600, probe_ports=False):
+        """
+        Start all the non started nodes of this cluster. With parallel=True,
+        all nodes are launched and then waited for concurrently (using at most
+        max_workers threads) until they are ready and have seen each other UP,
+        timeout being a deadline (in seconds) for the whole start. With
+        probe_ports=True, a node is considered ready once its ports accept
+        connections (see Node.wait_for_ports) rather than when its log says so.
+        """
         started = []
+        Node.refresh_status(list(self.nodes.values()))
         for node in list(self.nodes.values()):
             if not node.is_running():
                 mark = 0
@@ -239,12 +665,21 @@ class Cluster():
                 p = node.start(update_pid=False, jvm_args=jvm_args, profile_options=profile_options)
                 started.append((node, p, mark))
 
+        if parallel:
+            return self.__wait_for_started(started, no_wait, verbose, wait_for_binary_proto, max_workers, timeout, probe_ports)
+
         if no_wait and not verbose:
             time.sleep(2) # waiting 2 seconds to check for early errors and for the pid to be set
         else:
+            if probe_ports:
+                for node, p, _ in started:
+                    node._drain_output(p, verbose)
             for node, p, mark in started:
                 try:
-                    node.watch_log_for("Listening for thrift clients...", process=p, verbose=verbose, from_mark=mark)
+                    if probe_ports:
+                        node.wait_for_ports(timeout=timeout, process=p, verbose=verbose)
+                    else:
+                        node.watch_log_for("Listening for thrift clients...", process=p, verbose=verbose, from_mark=mark)
                 except RuntimeError:
                     return None
 
@@ -257,23 +692,77 @@ class Cluster():
         if not no_wait and self.version() >= "0.8":
             # 0.7 gossip messages seems less predictible that from 0.8 onwards and
             # I don't care enough
-            for node, _, mark in started:
-                for other_node, _, _ in started:
-                    if other_node is not node:
-                        node.watch_log_for_alive(other_node, from_mark=mark)
+            self.wait_for_convergence([ (node, mark) for node, _, mark in started ])
 
         if wait_for_binary_proto:
-            for node, _, mark in started:
-                node.watch_log_for("Starting listening for CQL clients", process=p, verbose=verbose, from_mark=mark)
-            time.sleep(0.2)
+            for node, p, mark in started:
+                if probe_ports:
+                    node.wait_for_ports(['binary'], timeout=timeout, process=p, verbose=verbose)
+                else:
+                    node.watch_log_for("Starting listening for CQL clients", process=p, verbose=verbose, from_mark=mark)
+            if not probe_ports:
+                time.sleep(0.2)
 
         return started
 
-    def stop(self, wait=True, gently=True):
+    def wait_for_convergence(self, marks, nodes=None, timeout=120, max_workers=None):
+        """
+        Wait until each node of marks, a list of (node, mark) pairs, has seen
+        all the provided nodes (all the nodes of marks by default) UP in its
+        log after its mark. The logs are scanned concurrently through the
+        cluster LogBus, each line once for all the addresses (max_workers is
+        ignored, and only kept for compatibility). A TimeoutError is raised
+        if some nodes haven't been seen UP everywhere after timeout seconds.
+        """
+        if nodes is None:
+            nodes = [ node for node, _ in marks ]
+
+        deadline = time.time() + timeout
+        bus = self.log_bus()
+        futures = []
+        for node, mark in marks:
+            others = [ other for other in nodes if other is not node ]
+            futures.append(bus.subscribe_addresses(node, "%s.* now UP", others, from_mark=mark))
+        errors = []
+        for future in futures:
+            try:
+                future.result(timeout=max(0, deadline - time.time()))
+            except TimeoutError as e:
+                bus.unsubscribe(future)
+                errors.append(e)
+        if len(errors) > 0:
+            raise TimeoutError("\n".join([ str(e) for e in errors ]))
+
+    def stop(self, wait=True, gently=True, timeout=STOP_TIMEOUT):
+        """
+        Stop all the nodes of this cluster. All the nodes are signaled first,
+        and then waited for together, so stopping takes as long as the slowest
+        node. Nodes still running after timeout seconds are killed with a
+        'kill -9'. Returns the list of the nodes that were not running.
+        """
+        if common.is_win():
+            not_running = []
+            for node in list(self.nodes.values()):
+                if not node.stop(wait, gently=gently):
+                    not_running.append(node)
+            return not_running
+
         not_running = []
+        stopping = []
+        Node.refresh_status(list(self.nodes.values()))
         for node in list(self.nodes.values()):
-            if not node.stop(wait, gently=gently):
+            if node.is_running():
+                node._signal_stop(gently)
+                stopping.append(node)
+            else:
                 not_running.append(node)
+
+        with self.batch():
+            for node in not_running:
+                # record the status of the nodes found dead since last saved
+                node._save_status()
+            if wait:
+                Node._wait_for_exit(stopping, timeout)
         return not_running
 
     def set_log_level(self, new_level, class_name=None):
@@ -281,11 +770,10 @@ class Cluster():
         if new_level not in known_level:
             raise common.ArgumentError("Unknown log level %s (use one of %s)" % (new_level, " ".join(known_level)))
 
-        self.__log_level = new_level
-        self.__update_config()
-
-        for node in self.nodelist():
-            node.set_log_level(new_level, class_name)
+        with self.batch():
+            self.__log_level = new_level
+            self.__update_config()
+            self.__for_each_node(lambda node: node.set_log_level(new_level, class_name))
 
     def nodetool(self, nodetool_cmd):
         for node in list(self.nodes.values()):
@@ -330,9 +818,9 @@ class Cluster():
                 self._config_options["commitlog_sync_period_in_ms"] = 10000
                 self._config_options["commitlog_sync_batch_window_in_ms"] = None
 
-        self.__update_config()
-        for node in list(self.nodes.values()):
-            node.import_config_files()
+        with self.batch():
+            self.__update_config()
+            self.__for_each_node(lambda node: node.import_config_files())
         return self
 
     def flush(self):
@@ -359,6 +847,7 @@ class Cluster():
         self.nodetool("removeToken " + str(token))
 
     def bulkload(self, options):
+        from ccmlib.bulkloader import BulkLoader
         loader = BulkLoader(self)
         loader.load(options)
 
@@ -367,38 +856,160 @@ class Cluster():
             node.scrub(options)
 
     def update_log4j(self, new_log4j_config):
-        # iterate over all nodes
-        for node in self.nodelist():
-            node.update_log4j(new_log4j_config)
+        self.__for_each_node(lambda node: node.update_log4j(new_log4j_config))
 
     def update_logback(self, new_logback_config):
-        # iterate over all nodes
-        for node in self.nodelist():
-            node.update_logback(new_logback_config)
+        self.__for_each_node(lambda node: node.update_logback(new_logback_config))
+
+    def grep_log(self, expr, nodes=None, since=None, until=None, max_matches=None, stop_on_match=False, processes=None, archives=True, newest_first=False):
+        """
+        Search the logs of nodes (all the nodes of this cluster by default) as
+        Node.grep_log does (archives and newest_first are passed along to
+        it), with a pool of processes (up to processes, one per
+        CPU by default) as the search is CPU bound. Returns a dict mapping each
+        node whose log has matching lines to the list of its (line, match
+        object) pairs, at most max_matches of them per node if provided. If
+        stop_on_match is True, returns as soon as a node has a match, with the
+        first match of that node.
+        """
+        if nodes is None:
+            nodes = self.nodelist()
+        # the files to search of each node with some, by log name
+        logs = {}
+        for node in nodes:
+            filename = node.logfilename()
+            files = [ f for f in [ filename ] + (rotated_logs(filename) if archives else []) if os.path.exists(f) ]
+            if len(files) > 0:
+                logs[filename] = (node, files)
+        pattern = re.compile(expr)
+        if stop_on_match:
+            max_matches = 1
+        tasks = [ (filename, pattern.pattern, pattern.flags, since, until, max_matches, archives, newest_first) for filename in sorted(logs) ]
+
+        results = {}
+        def add(filename, lines):
+            # Returns True once the search can stop
+            if len(lines) > 0:
+                results[logs[filename][0]] = [ (line, pattern.search(line)) for line in lines ]
+            return stop_on_match and len(lines) > 0
+
+        import multiprocessing
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(tasks))
+        size = sum([ os.path.getsize(f) for _, files in logs.values() for f in files ])
+        if processes < 2 or size < PARALLEL_GREP_MIN_SIZE:
+            # not worth starting processes
+            for task in tasks:
+                if add(*grep_log_lines(task)):
+                    break
+            return results
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            for filename, lines in pool.imap_unordered(grep_log_lines, tasks):
+                if add(filename, lines):
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+    def __for_each_node(self, function, nodes=None):
+        # Per-node work (mostly file updates) is done concurrently. If it fails
+        # on a single node, that node's error is re-raised as is, otherwise a
+        # NodesError reports the error of each failed node.
+        if nodes is None:
+            nodes = self.nodelist()
+        _, errors = common.run_in_parallel(function, nodes, max_workers=FAN_OUT_WORKERS)
+        for e in errors.values():
+            if isinstance(e, SystemExit):
+                raise e
+        if len(errors) == 1:
+            raise list(errors.values())[0]
+        if len(errors) > 1:
+            raise common.NodesError(dict([ (node.name, e) for node, e in errors.items() ]))
 
     def __get_version_from_build(self):
         return common.get_version_from_build(self.get_cassandra_dir())
 
     def __update_config(self):
-        node_list = [ node.name for node in list(self.nodes.values()) ]
-        seed_list = [ node.name for node in self.seeds ]
-        filename = os.path.join(self.__path, self.name, 'cluster.conf')
-        with open(filename, 'w') as f:
-            yaml.safe_dump({
-                'name' : self.name,
-                'nodes' : node_list,
-                'seeds' : seed_list,
-                'partitioner' : self.partitioner,
-                'cassandra_dir' : self.__cassandra_dir,
-                'config_options' : self._config_options,
-                'log_level' : self.__log_level
-            }, f)
+        if self.__batch_depth > 0:
+            self.__pending_cluster = True
+        else:
+            self.__write_configs(self.__config_values(), [])
+
+    def __config_values(self):
+        return {
+            'name' : self.name,
+            'nodes' : list(self.nodes.keys()),
+            'seeds' : [ node.name for node in self.seeds ],
+            'partitioner' : self.partitioner,
+            'cassandra_dir' : self.__cassandra_dir,
+            'config_options' : self._config_options,
+            'log_level' : self.__log_level
+        }
+
+    def __wait_for_started(self, started, no_wait, verbose, wait_for_binary_proto, max_workers, timeout, probe_ports):
+        deadline = time.time() + timeout
+        processes = dict([ (node, p) for node, p, _ in started ])
+        marks = dict([ (node, mark) for node, _, mark in started ])
+
+        def remaining():
+            return max(0, deadline - time.time())
+
+        def wait_for(nodes, wait_function):
+            _, errors = common.run_in_parallel(wait_function, nodes, max_workers=max_workers, timeout=remaining() + 5)
+            if len(errors) == 0:
+                return
+            for node in sorted(errors.keys(), key=lambda n: n.name):
+                print_("[%s] Error while starting: %s" % (node.name, str(errors[node]) or type(errors[node]).__name__), file=sys.stderr)
+            # a failing process has already printed its output, just tell the caller
+            if any([ isinstance(e, RuntimeError) for e in errors.values() ]):
+                return True
+            raise TimeoutError("\n".join([ "[%s] %s" % (node.name, errors[node]) for node in sorted(errors.keys(), key=lambda n: n.name) ]))
+
+        nodes = [ node for node, _, _ in started ]
+        if no_wait and not verbose:
+            time.sleep(2) # waiting 2 seconds to check for early errors and for the pid to be set
+        elif probe_ports:
+            for node in nodes:
+                node._drain_output(processes[node], verbose)
+            if wait_for(nodes, lambda node: node.wait_for_ports(timeout=remaining(), process=processes[node], verbose=verbose)):
+                return None
+        elif wait_for(nodes, lambda node: node.watch_log_for("Listening for thrift clients...", process=processes[node], verbose=verbose, from_mark=marks[node], timeout=remaining())):
+            return None
+
+        self.__update_pids(started)
 
-    def __update_pids(self, started):
         for node, p, _ in started:
-            node._update_pid(p)
+            if not node.is_running():
+                raise NodeError("Error starting {0}.".format(node.name), p)
+
+        if not no_wait and self.version() >= "0.8":
+            self.wait_for_convergence([ (node, marks[node]) for node in nodes ], timeout=remaining(), max_workers=max_workers)
+
+        if wait_for_binary_proto:
+            if probe_ports:
+                if wait_for(nodes, lambda node: node.wait_for_ports(['binary'], timeout=remaining(), process=processes[node], verbose=verbose)):
+                    return None
+            else:
+                if wait_for(nodes, lambda node: node.watch_log_for("Starting listening for CQL clients", process=processes[node], verbose=verbose, from_mark=marks[node], timeout=remaining())):
+                    return None
+                time.sleep(0.2)
+
+        return started
+
+    def __update_pids(self, started):
+        with self.batch():
+            for node, p, _ in started:
+                node._update_pid(p)
 
     def __update_topology_files(self):
+        if self.__batch_depth > 0:
+            self.__pending_topology = True
+            return
+
         dcs = [('default', 'dc1')]
         for node in self.nodelist():
             if node.data_center is not None:
@@ -410,5 +1021,6 @@ class Cluster():
 
         for node in self.nodelist():
             topology_file = os.path.join(node.get_conf_dir(), 'cassandra-topology.properties')
+            common.unshare_file(topology_file)
             with open(topology_file, 'w') as f:
                 f.write(content)
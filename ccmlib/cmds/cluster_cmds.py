@@ -1,37 +1,17 @@
 import os
+import signal
 import sys
 
 from six import print_
 
-from ccmlib import common, repository
-from ccmlib.node import Node, NodeError
+from ccmlib import common, daemon
+from ccmlib.node import Node, NodeError, Status
 from ccmlib.cluster import Cluster
+from ccmlib.cmds import dispatch
 from ccmlib.cmds.command import Cmd
 
 def cluster_cmds():
-    return [
-        "create",
-        "add",
-        "populate",
-        "list",
-        "switch",
-        "status",
-        "remove",
-        "clear",
-        "liveset",
-        "start",
-        "stop",
-        "flush",
-        "compact",
-        "stress",
-        "updateconf",
-        "updatelog4j",
-        "cli",
-        "setdir",
-        "bulkload",
-        "setlog",
-        "scrub",
-    ]
+    return dispatch.CLUSTER_CMDS
 
 def parse_populate_count(v):
     if v is None:
@@ -242,7 +222,10 @@ class ClusterListCmd(Cmd):
 
     def get_parser(self):
         usage = "usage: ccm list [options]"
-        return self._get_default_parser(usage, self.description())
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('--status', action="store_true", dest="status",
+            help="Check which nodes of each cluster are running (and look for clusters missing from the registry)", default=False)
+        return parser
 
     def validate(self, parser, options, args):
         Cmd.validate(self, parser, options, args)
@@ -253,9 +236,41 @@ class ClusterListCmd(Cmd):
         except Exception as e:
             current = ''
 
-        for dir in os.listdir(self.path):
-            if os.path.exists(os.path.join(self.path, dir, 'cluster.conf')):
-                print_(" %s%s" % ('*' if current == dir else ' ', dir))
+        # ccm keeps the registry up to date. It is rebuilt from the cluster
+        # directories (but not repository/) when there is none yet, or with
+        # --status; otherwise only the clusters removed by hand are dropped
+        registry = common.load_registry(self.path)
+        if registry is None or self.options.status:
+            names = [ name for name in os.listdir(self.path) if name != 'repository' and common.is_cluster_dir(os.path.join(self.path, name)) ]
+        else:
+            names = [ name for name in registry.keys() if common.is_cluster_dir(os.path.join(self.path, name)) ]
+        for name in (registry or {}).keys():
+            if name not in names:
+                common.remove_from_registry(self.path, name)
+        if registry is None or self.options.status:
+            registry = self.__refresh_registry(names)
+
+        for name in sorted(names):
+            if not self.options.status or name not in registry:
+                print_(" %s%s" % ('*' if current == name else ' ', name))
+                continue
+            entry = registry[name]
+            statuses = list(entry['nodes'].values())
+            up = len([ status for status in statuses if status in (Status.UP, Status.DECOMMISIONNED) ])
+            print_(" %s%s (%s, %d nodes, %d up)" % ('*' if current == name else ' ', name, entry['version'] or 'unknown version', len(statuses), up))
+
+    def __refresh_registry(self, names):
+        # Registers the clusters names, with the current status of every
+        # node if asked. Clusters are loaded in parallel, and all their nodes
+        # checked with a single process scan
+        clusters, errors = common.run_in_parallel(lambda name: Cluster.load(self.path, name, lazy=True), names)
+        for name in sorted(errors.keys()):
+            print_("Error loading cluster %s: %s" % (name, str(errors[name])), file=sys.stderr)
+        if self.options.status:
+            Node.refresh_status([ node for cluster in clusters.values() for node in list(cluster.nodes.values()) ])
+        for cluster in clusters.values():
+            cluster._register()
+        return common.load_registry(self.path) or {}
 
 class ClusterSwitchCmd(Cmd):
     def description(self):
@@ -267,11 +282,20 @@ class ClusterSwitchCmd(Cmd):
 
     def validate(self, parser, options, args):
         Cmd.validate(self, parser, options, args, cluster_name=True)
-        if not os.path.exists(os.path.join(self.path, self.name, 'cluster.conf')):
+        if not common.is_cluster_dir(os.path.join(self.path, self.name)):
+            common.remove_from_registry(self.path, self.name)
             print_("%s does not appear to be a valid cluster (use ccm cluster list to view valid cluster)" % self.name, file=sys.stderr)
             exit(1)
 
     def run(self):
+        registry = common.load_registry(self.path)
+        if registry is not None and self.name not in registry:
+            # created by an older ccm: check it loads, and register it
+            try:
+                Cluster.load(self.path, self.name, lazy=True)._register()
+            except common.LoadError as e:
+                print_(str(e), file=sys.stderr)
+                exit(1)
         common.switch_cluster(self.path, self.name)
 
 class ClusterStatusCmd(Cmd):
@@ -306,8 +330,7 @@ class ClusterRemoveCmd(Cmd):
             # Setup to remove the specified cluster:
             Cmd.validate(self, parser, options, args)
             self.other_cluster = args[0]
-            if not os.path.exists(os.path.join(
-                    self.path, self.other_cluster, 'cluster.conf')):
+            if not common.is_cluster_dir(os.path.join(self.path, self.other_cluster)):
                 print_("%s does not appear to be a valid cluster" \
                     " (use ccm cluster list to view valid cluster)" \
                     % self.other_cluster, file=sys.stderr)
@@ -397,6 +420,7 @@ class ClusterClearrepoCmd(Cmd):
         Cmd.validate(self, parser, options, args)
 
     def run(self):
+        from ccmlib import repository
         repository.clean_all()
 
 class ClusterStartCmd(Cmd):
@@ -416,6 +440,12 @@ class ClusterStartCmd(Cmd):
             help="Start the nodes with yourkit agent (only valid with -s)", default=False)
         parser.add_option('--profile-opts', type="string", action="store", dest="profile_options",
             help="Yourkit options when profiling", default=None)
+        parser.add_option('--parallel', action="store_true", dest="parallel",
+            help="Wait for all the nodes to be ready concurrently", default=False)
+        parser.add_option('--max-workers', type="int", dest="max_workers",
+            help="With --parallel, maximum number of nodes waited for at the same time [default: all]", default=None)
+        parser.add_option('--probe-ports', action="store_true", dest="probe_ports",
+            help="Consider nodes ready once their ports accept connections rather than watching their log", default=False)
         return parser
 
     def validate(self, parser, options, args):
@@ -428,7 +458,7 @@ class ClusterStartCmd(Cmd):
                 profile_options = {}
                 if self.options.profile_options:
                     profile_options['options'] = self.options.profile_options
-            if self.cluster.start(no_wait=self.options.no_wait, verbose=self.options.verbose, jvm_args=self.options.jvm_args, profile_options=profile_options) is None:
+            if self.cluster.start(no_wait=self.options.no_wait, verbose=self.options.verbose, jvm_args=self.options.jvm_args, profile_options=profile_options, parallel=self.options.parallel, max_workers=self.options.max_workers, probe_ports=self.options.probe_ports) is None:
                 details = ""
                 if not self.options.verbose:
                     details = " (you can use --verbose for more information)"
@@ -672,3 +702,34 @@ class ClusterSetlogCmd(Cmd):
         except common.ArgumentError as e:
             print_(str(e), file=sys.stderr)
             exit(1)
+
+class ClusterDaemonCmd(Cmd):
+    def description(self):
+        return "Run a ccm daemon, to which ccm forwards commands while it runs"
+
+    def get_parser(self):
+        usage = "usage: ccm daemon [options]"
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('--stop', action="store_true", dest="stop",
+            help="Stop the running daemon", default=False)
+        return parser
+
+    def validate(self, parser, options, args):
+        Cmd.validate(self, parser, options, args)
+
+    def run(self):
+        if self.options.stop:
+            if not daemon.stop(self.path):
+                print_("No ccm daemon running", file=sys.stderr)
+                exit(1)
+            return
+
+        server = daemon.Daemon(self.path)
+        signal.signal(signal.SIGTERM, lambda *args: server.shutdown())
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        except common.CCMError as e:
+            print_(str(e), file=sys.stderr)
+            exit(1)
@@ -5,7 +5,6 @@ from six import print_
 from optparse import OptionParser, BadOptionError, Option
 
 from ccmlib import common
-from ccmlib.cluster import Cluster
 
 # This is fairly fragile, but handy for now
 class ForgivingParser(OptionParser):
@@ -37,6 +36,9 @@ class ForgivingParser(OptionParser):
         return self.ignored
 
 class Cmd(object):
+    # set by the ccm daemon to reuse the clusters it has loaded
+    cluster_cache = None
+
     def get_parser(self):
         pass
 
@@ -91,7 +93,10 @@ class Cmd(object):
             print_('No currently active cluster (use ccm cluster switch)')
             exit(1)
         try:
-            return Cluster.load(self.path, name)
+            if Cmd.cluster_cache is not None:
+                return Cmd.cluster_cache.get(self.path, name)
+            from ccmlib.cluster import Cluster
+            return Cluster.load(self.path, name, lazy=True)
         except common.LoadError as e:
             print_(str(e))
             exit(1)
@@ -0,0 +1,85 @@
+# static table of the ccm commands
+#
+# The ccm script looks commands up here rather than in the command modules, so
+# that it only imports the module (and dependencies) of the command it runs.
+# Command <name> of kind <kind> is the class <Kind><Name>Cmd of the module of
+# its kind.
+import importlib
+
+CLUSTER_CMDS = [
+    "create",
+    "add",
+    "populate",
+    "list",
+    "switch",
+    "status",
+    "remove",
+    "clear",
+    "liveset",
+    "start",
+    "stop",
+    "flush",
+    "compact",
+    "stress",
+    "updateconf",
+    "updatelog4j",
+    "cli",
+    "setdir",
+    "bulkload",
+    "setlog",
+    "scrub",
+    "daemon",
+]
+
+NODE_CMDS = [
+    "show",
+    "remove",
+    "showlog",
+    "setlog",
+    "start",
+    "stop",
+    "ring",
+    "flush",
+    "compact",
+    "drain",
+    "cleanup",
+    "repair",
+    "scrub",
+    "shuffle",
+    "sstablesplit",
+    "decommission",
+    "json",
+    "updateconf",
+    "updatelog4j",
+    "stress",
+    "cli",
+    "cqlsh",
+    "scrub",
+    "status",
+    "setdir",
+    "version",
+    "nodetool"
+]
+
+MODULES = {
+    'cluster' : 'ccmlib.cmds.cluster_cmds',
+    'node' : 'ccmlib.cmds.node_cmds',
+}
+
+def command_names(kind):
+    return CLUSTER_CMDS if kind.lower() == 'cluster' else NODE_CMDS
+
+def get_command(kind, name):
+    """
+    Returns a new instance of the command name of kind ('cluster' or 'node'),
+    importing its module on first use, or None if there is no such command.
+    """
+    kind, name = kind.lower(), name.lower()
+    if name not in command_names(kind):
+        return None
+    from ccmlib.cmds.command import Cmd
+    module = importlib.import_module(MODULES[kind])
+    klass = getattr(module, kind.capitalize() + name.capitalize() + "Cmd", None)
+    if klass is None or not issubclass(klass, Cmd):
+        return None
+    return klass()
@@ -1,42 +1,20 @@
+import errno
 import os
+import shutil
+import subprocess
 import sys
 
 from six import print_
 
 from ccmlib import common
+from ccmlib.log_index import line_timestamp, to_timestamp
+from ccmlib.log_search import open_archive, rotated_logs
 from ccmlib.node import NodeError
+from ccmlib.cmds import dispatch
 from ccmlib.cmds.command import Cmd
 
 def node_cmds():
-    return [
-        "show",
-        "remove",
-        "showlog",
-        "setlog",
-        "start",
-        "stop",
-        "ring",
-        "flush",
-        "compact",
-        "drain",
-        "cleanup",
-        "repair",
-        "scrub",
-        "shuffle",
-        "sstablesplit",
-        "decommission",
-        "json",
-        "updateconf",
-        "updatelog4j",
-        "stress",
-        "cli",
-        "cqlsh",
-        "scrub",
-        "status",
-        "setdir",
-        "version",
-        "nodetool"
-    ]
+    return dispatch.NODE_CMDS
 
 class NodeShowCmd(Cmd):
     def description(self):
@@ -72,15 +50,75 @@ class NodeShowlogCmd(Cmd):
 
     def get_parser(self):
         usage = "usage: ccm node_name showlog [options]"
-        return self._get_default_parser(usage, self.description())
+        parser = self._get_default_parser(usage, self.description())
+        parser.add_option('--since', type="string", dest="since", default=None,
+            help="Show the log from the first line logged at or after that time ('YYYY-MM-DD HH:MM:SS[,mmm]')")
+        parser.add_option('-a', '--archives', action="store_true", dest="archives", default=False,
+            help="Show the archives left by the rotations of the log before it")
+        return parser
 
     def validate(self, parser, options, args):
         Cmd.validate(self, parser, options, args, node_name=True, load_cluster=True)
+        if options.since is not None:
+            try:
+                to_timestamp(options.since)
+            except common.ArgumentError as e:
+                print_(str(e), file=sys.stderr)
+                exit(1)
 
     def run(self):
         log = self.node.logfilename()
         pager = os.environ.get('PAGER', common.platform_pager())
-        os.execvp(pager, (pager, log))
+        if self.options.archives:
+            self.__run_with_archives(log, pager)
+            return
+        if self.options.since is None:
+            os.execvp(pager, (pager, log))
+        # the pager reads the log from its standard input, opened at the mark
+        f = open(log, 'rb')
+        f.seek(self.node.mark_log(since=self.options.since))
+        os.dup2(f.fileno(), sys.stdin.fileno())
+        os.execvp(pager, (pager,))
+
+    def __run_with_archives(self, log, pager):
+        # the archives (decompressed on the fly) and then the log are piped
+        # to the pager
+        since = to_timestamp(self.options.since) if self.options.since is not None else None
+        process = subprocess.Popen([ pager ], stdin=subprocess.PIPE)
+        try:
+            for path in reversed(rotated_logs(log)):
+                try:
+                    stream = open_archive(path)
+                except (IOError, OSError):
+                    continue
+                with stream:
+                    since = self.__copy(stream, process.stdin, since)
+            if os.path.exists(log):
+                with open(log, 'rb') as f:
+                    if since is not None:
+                        f.seek(self.node.mark_log(since=since))
+                    shutil.copyfileobj(f, process.stdin)
+            process.stdin.close()
+        except IOError as e:
+            # the pager was quit
+            if e.errno != errno.EPIPE:
+                raise
+        process.wait()
+
+    def __copy(self, stream, out, since):
+        # Copies the lines of stream logged at or after since. Returns None
+        # once such a line has been found (the rest of the log follows it).
+        if since is None:
+            shutil.copyfileobj(stream, out)
+            return None
+        for line in stream:
+            if since is not None:
+                timestamp = line_timestamp(line)
+                if timestamp is None or timestamp < since:
+                    continue
+                since = None
+            out.write(line)
+        return since
 
 class NodeSetlogCmd(Cmd):
     def description(self):
@@ -149,6 +187,8 @@ class NodeStartCmd(Cmd):
             help="Replace a node in the ring through the cassandra.replace_address option")
         parser.add_option('--jvm_arg', action="append", dest="jvm_args",
             help="Specify a JVM argument", default=[])
+        parser.add_option('--probe-ports', action="store_true", dest="probe_ports",
+            help="Consider the node ready once its ports accept connections", default=False)
         return parser
 
     def validate(self, parser, options, args):
@@ -160,7 +200,8 @@ class NodeStartCmd(Cmd):
                             no_wait=self.options.no_wait,
                             verbose=self.options.verbose,
                             replace_address=self.options.replace_address,
-                            jvm_args=self.options.jvm_args)
+                            jvm_args=self.options.jvm_args,
+                            probe_ports=self.options.probe_ports)
         except NodeError as e:
             print_(str(e), file=sys.stderr)
             print_("Standard error output is:", file=sys.stderr)
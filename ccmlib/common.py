@@ -2,16 +2,20 @@
 # Cassandra Cluster Management lib
 #
 
+import copy
 import os
+import errno
 import re
+import select
 import shutil
-import socket
 import stat
 import subprocess
 import sys
+import tempfile
 from six import print_
+from six.moves import queue
+import threading
 import time
-import yaml
 
 CASSANDRA_BIN_DIR= "bin"
 CASSANDRA_CONF_DIR= "conf"
@@ -24,8 +28,19 @@ CASSANDRA_ENV = "cassandra-env.sh"
 CASSANDRA_WIN_ENV = "cassandra-env.ps1"
 CASSANDRA_SH = "cassandra.in.sh"
 
+CLUSTER_CONF = "cluster.conf"
+NODE_CONF = "node.conf"
+# single file holding the state of a cluster and all its nodes, in place of
+# cluster.conf and node.conf (see use_state_file())
+CLUSTER_STATE = "state.yaml"
+# index of the clusters of a ccm directory (see update_registry())
+REGISTRY = "registry"
+
 CONFIG_FILE = "config"
 
+# ioctl request to clone a file's extents (reflink) on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
 class CCMError(Exception):
     pass
 
@@ -38,6 +53,15 @@ class ArgumentError(CCMError):
 class UnavailableSocketError(CCMError):
     pass
 
+class NodesError(CCMError):
+    """
+    Raised when an operation failed on several nodes. errors maps the name
+    of each of these nodes to the exception it raised.
+    """
+    def __init__(self, errors):
+        CCMError.__init__(self, "; ".join([ "%s: %s" % (name, errors[name]) for name in sorted(errors.keys()) ]))
+        self.errors = errors
+
 def get_default_path():
     default_path = os.path.join(get_user_home(), '.ccm')
     if not os.path.exists(default_path):
@@ -61,7 +85,103 @@ def get_config():
         return {}
 
     with open(config_path, 'r') as f:
-        return yaml.load(f)
+        return load_yaml(f) or {}
+
+_yaml = None
+
+def _get_yaml():
+    """
+    Returns the yaml module with its (libyaml if available) safe loader and
+    dumper, imported on first use: it's one of the slowest modules to import
+    and some commands don't need it.
+    """
+    global _yaml
+    if _yaml is None:
+        import yaml
+        try:
+            from yaml import CSafeLoader as loader, CSafeDumper as dumper
+        except ImportError:
+            from yaml import SafeLoader as loader, SafeDumper as dumper
+        _yaml = (yaml, loader, dumper)
+    return _yaml
+
+def load_yaml(stream):
+    """
+    Safely parse yaml from a string or file, using libyaml if available.
+    """
+    yaml, loader, _ = _get_yaml()
+    return yaml.load(stream, Loader=loader)
+
+def dump_yaml(data, stream=None, **kwargs):
+    """
+    Safely serialize data to yaml (returned as a string if stream is None),
+    using libyaml if available.
+    """
+    yaml, _, dumper = _get_yaml()
+    return yaml.dump(data, stream, Dumper=dumper, **kwargs)
+
+# use_state_file() of each ccm directory, as read the first time
+_state_file_settings = {}
+
+def use_state_file(path):
+    """
+    Whether the clusters of the ccm directory path (~/.ccm or the one passed
+    with --config-dir) should keep their state in a single file
+    (CLUSTER_STATE) rather than in a cluster.conf and a node.conf per node.
+    This is enabled by setting 'state_file: true' in the config file of that
+    directory; existing clusters are then migrated when they are loaded. The
+    setting is only read once.
+    """
+    path = os.path.abspath(path)
+    if path not in _state_file_settings:
+        config = {}
+        try:
+            with open(os.path.join(path, CONFIG_FILE), 'r') as f:
+                config = load_yaml(f) or {}
+        except IOError:
+            pass
+        _state_file_settings[path] = isinstance(config, dict) and bool(config.get('state_file', False))
+    return _state_file_settings[path]
+
+def is_cluster_dir(path):
+    return os.path.exists(os.path.join(path, CLUSTER_CONF)) or os.path.exists(os.path.join(path, CLUSTER_STATE))
+
+def write_file_atomically(filename, content, sync=True):
+    """
+    Write content to filename so that readers (and crashes) see either the
+    previous or the new content, never a partially written file: content
+    goes to a temporary file which is synced and then renamed. Without sync
+    (for caches, which can be lost), readers still never see a partially
+    written file but nothing is synced.
+    """
+    dir_name = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(filename), suffix='.tmp', dir=dir_name)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, stat.S_IMODE(os.stat(filename).st_mode))
+        except OSError:
+            os.chmod(tmp, 0o644)
+        if hasattr(os, 'replace'):
+            os.replace(tmp, filename)
+        else:
+            if is_win() and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync and not is_win():
+        dir_fd = os.open(dir_name, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 def now_ms():
     return int(round(time.time() * 1000))
@@ -86,6 +206,127 @@ def switch_cluster(path, new_name):
     with open(os.path.join(path, 'CURRENT'), 'w') as f:
         f.write(new_name + '\n')
 
+class FileLock():
+    """
+    An exclusive lock on a file, shared by threads and processes (it's an
+    flock on a companion filename.lock file), to make read-modify-write of
+    files safe when several ccm commands run concurrently:
+
+        with common.FileLock(filename):
+            ...
+
+    The lock is not reentrant.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename + '.lock'
+        self.__fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if is_win():
+                import msvcrt
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except (IOError, OSError):
+                        # LK_LOCK only retries for 10 seconds
+                        pass
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except:
+            os.close(fd)
+            raise
+        self.__fd = fd
+
+    def release(self):
+        if self.__fd is None:
+            return
+        try:
+            if is_win():
+                import msvcrt
+                os.lseek(self.__fd, 0, os.SEEK_SET)
+                msvcrt.locking(self.__fd, msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
+
+_registry_lock = threading.Lock()
+
+def load_registry(path):
+    """
+    Returns the registry of the clusters of path, a dict of
+    {cluster name: {'version': ..., 'nodes': {node name: status}}} or None
+    if it doesn't exist yet.
+    """
+    filename = os.path.join(path, REGISTRY)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return load_yaml(f) or {}
+
+def update_registry(path, name, version=None, statuses=None, node_names=None, create=False):
+    """
+    Record what is known of the cluster name in the registry of path: its
+    version, the (last known) status of some of its nodes as a dict
+    {node name: status} and, if node_names is provided, its full list of
+    nodes (statuses of the other nodes are dropped). Unless create is True,
+    nothing is done if there is no registry yet: it's first built from all
+    the clusters of path (by ccm list).
+    """
+    registry = load_registry(path)
+    if registry is None and not create:
+        return
+    if registry is not None and name in registry and _registry_entry(registry[name], version, statuses, node_names) == registry[name]:
+        # nothing new: don't take the locks nor rewrite the registry
+        return
+    with _registry_lock, FileLock(os.path.join(path, REGISTRY)):
+        registry = load_registry(path)
+        if registry is None:
+            if not create:
+                return
+            registry = {}
+        entry = _registry_entry(registry.get(name), version, statuses, node_names)
+        if registry.get(name) == entry:
+            return
+        registry[name] = entry
+        write_file_atomically(os.path.join(path, REGISTRY), dump_yaml(registry))
+
+def _registry_entry(entry, version, statuses, node_names):
+    # A copy of the registry entry of a cluster updated with what is known
+    entry = { 'version' : None, 'nodes' : {} } if entry is None else { 'version' : entry['version'], 'nodes' : dict(entry['nodes']) }
+    if version is not None:
+        entry['version'] = version
+    if statuses is not None:
+        entry['nodes'].update(statuses)
+    if node_names is not None:
+        for node_name in list(entry['nodes'].keys()):
+            if node_name not in node_names:
+                del entry['nodes'][node_name]
+        for node_name in node_names:
+            entry['nodes'].setdefault(node_name, None)
+    return entry
+
+def remove_from_registry(path, name):
+    with _registry_lock, FileLock(os.path.join(path, REGISTRY)):
+        registry = load_registry(path)
+        if registry is not None and name in registry:
+            del registry[name]
+            write_file_atomically(os.path.join(path, REGISTRY), dump_yaml(registry))
+
 def replace_in_file(file, regexp, replace):
     replaces_in_file(file, [(regexp, replace)])
 
@@ -100,7 +341,7 @@ def replaces_in_file(file, replacement_list):
                     if match:
                         line = replace + "\n"
                 f_tmp.write(line)
-    shutil.move(file_tmp, file)
+    replace_file(file_tmp, file)
 
 def replace_or_add_into_file_tail(file, regexp, replace):
     replaces_or_add_into_file_tail(file, [(regexp, replace)])
@@ -122,7 +363,100 @@ def replaces_or_add_into_file_tail(file, replacement_list):
             if is_line_found == False:
                 f_tmp.write('\n'+ replace + "\n")
 
-    shutil.move(file_tmp, file)
+    replace_file(file_tmp, file)
+
+def replace_file(src, dst):
+    """
+    Move src over dst. If dst is a link to an imported file (see
+    link_or_copy), only that link is replaced and the original is left
+    untouched.
+    """
+    unshare_file(dst)
+    shutil.move(src, dst)
+
+def unshare_file(path):
+    """
+    Remove path if it's one of several hardlinks to the same file, so that
+    it can be written without modifying the other ones. Any file imported
+    with link_or_copy must go through this (or replace_file) before being
+    written in place.
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+def hardlink_conf_files():
+    """
+    Whether the conf files of the installs may be hardlinked into the nodes
+    (see link_or_copy), which requires setting CCM_HARDLINK_CONF in the
+    environment: tools other than ccm (tests tweaking a node's
+    cassandra-rackdc.properties, ...) open them for writing in place, and
+    would then modify the install and every other node as well.
+    """
+    return bool(os.environ.get('CCM_HARDLINK_CONF'))
+
+def link_or_copy(src, dst, hardlink=False):
+    """
+    Import the src file as dst (which may be a directory). To save I/O and
+    disk space, this is a reflink (a copy-on-write clone) when the
+    filesystem supports it, else a hardlink if hardlink is True, and a plain
+    copy otherwise (or if CCM_COPY_FILES is set in the environment).
+    Hardlinked files are shared with the original and must not be written
+    in place (see unshare_file).
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if not os.environ.get('CCM_COPY_FILES'):
+        if _reflink(src, dst):
+            return
+        if hardlink:
+            try:
+                os.link(src, dst)
+                return
+            except (OSError, AttributeError):
+                pass
+    shutil.copy2(src, dst)
+
+def _reflink(src, dst):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        with open(src, 'rb') as f_src:
+            with open(dst, 'wb') as f_dst:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+_yaml_cache = {}
+_yaml_cache_lock = threading.Lock()
+
+def get_cached_yaml(filename):
+    """
+    Returns the parsed content of the yaml file filename. Files are only
+    parsed once per process (and again if they are modified): this is used
+    for the cassandra.yaml of the installs, from which the yaml of all the
+    nodes are generated. The result is a copy that the caller may modify.
+    """
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    with _yaml_cache_lock:
+        cached = _yaml_cache.get(key)
+    if cached is None or cached[0] != (st.st_mtime, st.st_size):
+        with open(filename, 'r') as f:
+            data = load_yaml(f)
+        cached = ((st.st_mtime, st.st_size), data)
+        with _yaml_cache_lock:
+            _yaml_cache[key] = cached
+    return copy.deepcopy(cached[1])
 
 def make_cassandra_env(cassandra_dir, node_path):
     if is_win() and get_version_from_build(node_path=node_path) >= '2.1':
@@ -131,6 +465,7 @@ def make_cassandra_env(cassandra_dir, node_path):
         sh_file = os.path.join(CASSANDRA_BIN_DIR, CASSANDRA_SH)
     orig = os.path.join(cassandra_dir, sh_file)
     dst = os.path.join(node_path, sh_file)
+    unshare_file(dst)
     shutil.copy(orig, dst)
     replacements = ""
     if is_win() and get_version_from_build(node_path=node_path) >= '2.1':
@@ -255,6 +590,7 @@ def validate_cassandra_dir(cassandra_dir):
         raise ArgumentError('%s does not appear to be a cassandra source directory' % cassandra_dir)
 
 def check_socket_available(itf):
+    import socket
     s = socket.socket()
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
@@ -265,6 +601,57 @@ def check_socket_available(itf):
         addr, port = itf
         raise UnavailableSocketError("Inet address %s:%s is not available: %s" % (addr, port, msg))
 
+def wait_for_ports(addresses, timeout, check=None):
+    """
+    Wait until something accepts TCP connections on each of the provided
+    (host, port) addresses, or until timeout (in seconds) expires. All the
+    addresses are probed at once with non-blocking connects, and refused ones
+    are retried with a short backoff. If provided, check is called between
+    attempts (and may raise to abort the wait). Returns the list of the
+    addresses that never accepted a connection.
+    """
+    import socket
+    deadline = time.time() + timeout
+    pending = list(addresses)
+    backoff = 0.01
+    while True:
+        connecting = {}
+        connected = []
+        for itf in pending:
+            host, port = itf
+            try:
+                family, socktype, proto, _, sockaddr = socket.getaddrinfo(host, int(port), 0, socket.SOCK_STREAM)[0]
+            except socket.gaierror:
+                # not resolvable (yet): not ready
+                continue
+            s = socket.socket(family, socktype, proto)
+            s.setblocking(0)
+            err = s.connect_ex(sockaddr)
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                connecting[s] = itf
+                continue
+            s.close()
+            if err == 0:
+                connected.append(itf)
+        sockets = list(connecting.keys())
+        if len(sockets) > 0:
+            try:
+                _, writable, _ = select.select([], sockets, [], max(0, min(0.5, deadline - time.time())))
+                for s in writable:
+                    if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        connected.append(connecting[s])
+            finally:
+                for s in sockets:
+                    s.close()
+
+        pending = [ itf for itf in pending if itf not in connected ]
+        if len(pending) == 0 or time.time() >= deadline:
+            return pending
+        if check is not None:
+            check()
+        time.sleep(min(backoff, max(0, deadline - time.time())))
+        backoff = min(backoff * 2, 0.25)
+
 def parse_settings(args):
     settings = {}
     for s in args:
@@ -289,11 +676,154 @@ def parse_settings(args):
 #
 def copy_file(src_file, dst_file):
     try:
+        unshare_file(dst_file)
         shutil.copy2(src_file, dst_file)
     except (IOError, shutil.Error) as e:
         print_(str(e), file=sys.stderr)
         exit(1)
 
+def run_in_parallel(function, items, max_workers=None, timeout=None):
+    """
+    Call function on each of items using at most max_workers threads (one
+    thread per item by default). Returns a pair of dicts (results, errors)
+    keyed by item: an exception raised for one item doesn't prevent the
+    others from completing. If timeout (in seconds) is provided, items that
+    are still running when it expires are reported with a CCMError.
+    """
+    items = list(items)
+    results = {}
+    errors = {}
+    if len(items) == 0:
+        return results, errors
+
+    todo = queue.Queue()
+    for item in items:
+        todo.put(item)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = function(item)
+                with lock:
+                    results[item] = result
+            except BaseException as e:
+                # including SystemExit, which would otherwise silently end the thread
+                with lock:
+                    errors[item] = e
+
+    if max_workers is None or max_workers > len(items):
+        max_workers = len(items)
+    threads = [ threading.Thread(target=worker) for i in range(0, max_workers) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    deadline = None if timeout is None else time.time() + timeout
+    for t in threads:
+        t.join(None if deadline is None else max(0, deadline - time.time()))
+
+    with lock:
+        for item in items:
+            if item not in results and item not in errors:
+                errors[item] = CCMError("Did not complete within %ss" % timeout)
+        return dict(results), dict(errors)
+
+def scan_processes(pids):
+    """
+    Reads /proc for the processes of pids in a single pass. Returns a dict
+    {pid: (start_time, cmdline)} of those that are running (zombies are
+    considered dead), start_time being in clock ticks since boot, or None
+    if /proc is not available.
+    """
+    if not os.path.isdir('/proc/self'):
+        return None
+    processes = {}
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid, 'rb') as f:
+                data = f.read()
+            with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                cmdline = f.read()
+        except (IOError, OSError):
+            continue
+        # the command name (between parenthesis) may contain spaces
+        fields = data[data.rfind(b')') + 2:].split()
+        if fields[0] in (b'Z', b'X'):
+            continue
+        processes[pid] = (int(fields[19]), cmdline.replace(b'\0', b' ').decode('utf-8', 'replace').strip())
+    return processes
+
+def is_process_running(pid):
+    """
+    Returns whether a process with this pid exists (not for Windows, where
+    os.kill would terminate it).
+    """
+    processes = scan_processes([pid])
+    if processes is not None:
+        return pid in processes
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        if err.errno in (errno.ESRCH, errno.EPERM):
+            return False
+        raise
+    return True
+
+def wait_for_processes_exit(pids, timeout):
+    """
+    Wait until none of the processes in pids is running anymore, or until
+    timeout (in seconds) expires. Returns the list of the pids still running.
+    On Linux, process exits are notified by the kernel through pidfds (from
+    python 3.9), otherwise the processes are polled every few milliseconds.
+    """
+    deadline = time.time() + timeout
+    running = set(pids)
+    pidfds = {}
+    poller = None
+    if hasattr(os, 'pidfd_open') and hasattr(select, 'poll'):
+        poller = select.poll()
+        for pid in list(running):
+            try:
+                fd = os.pidfd_open(pid)
+            except OSError as err:
+                if err.errno == errno.ESRCH:
+                    running.discard(pid)
+                continue
+            pidfds[fd] = pid
+            poller.register(fd, select.POLLIN)
+
+    try:
+        poll_interval = 0.01
+        while True:
+            for pid in [ pid for pid in running if pid not in pidfds.values() ]:
+                if not is_process_running(pid):
+                    running.discard(pid)
+            now = time.time()
+            if len(running) == 0 or now >= deadline:
+                break
+
+            if len(pidfds) > 0:
+                wait = deadline - now
+                if len(pidfds) < len(running):
+                    wait = min(wait, poll_interval)
+                for fd, _ in poller.poll(wait * 1000):
+                    running.discard(pidfds[fd])
+                    poller.unregister(fd)
+                    os.close(fd)
+                    del pidfds[fd]
+            else:
+                time.sleep(min(deadline - now, poll_interval))
+            poll_interval = min(poll_interval * 2, 0.2)
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+    return list(running)
+
 def get_version_from_build(cassandra_dir=None, node_path=None):
     if cassandra_dir is None and node_path is not None:
         cassandra_dir = get_cassandra_dir_from_cluster_conf(node_path)
@@ -307,7 +837,11 @@ def get_version_from_build(cassandra_dir=None, node_path=None):
     raise CCMError("Cannot find version")
 
 def get_cassandra_dir_from_cluster_conf(node_path):
-    file = os.path.join(os.path.dirname(node_path), "cluster.conf")
+    state_file = os.path.join(os.path.dirname(node_path), CLUSTER_STATE)
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            return load_yaml(f)['cluster'].get('cassandra_dir')
+    file = os.path.join(os.path.dirname(node_path), CLUSTER_CONF)
     with open(file) as f:
         for line in f:
             match = re.search('cassandra_dir: (.*?)$', line)
@@ -0,0 +1,305 @@
+# resident ccm process serving commands over a unix socket
+#
+# This module is imported by the ccm script before anything else, to forward
+# commands to a running daemon: keep its module level imports light (json and
+# socket are only imported once there is a daemon to talk to).
+import os
+import sys
+import threading
+
+from six import print_
+
+SOCKET_NAME = "daemon.sock"
+
+# Commands run by the daemon when it's running. The others are run by the ccm
+# script itself: they are interactive, print the output of subprocesses or
+# take paths relative to the current directory.
+FORWARDED_CLUSTER_CMDS = [ "add", "populate", "list", "switch", "status", "remove", "clear", "liveset", "start", "stop", "updateconf", "setlog" ]
+FORWARDED_NODE_CMDS = [ "show", "remove", "setlog", "start", "stop", "updateconf" ]
+
+def socket_path(path):
+    return os.path.join(path, SOCKET_NAME)
+
+def _config_dir(argv):
+    for i, arg in enumerate(argv):
+        if arg == '--config-dir' and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--config-dir='):
+            return arg[len('--config-dir='):]
+    return os.path.join(os.path.expanduser('~'), '.ccm')
+
+def _absolute_config_dir(argv):
+    # argv with its --config-dir made absolute, so that it doesn't depend on
+    # the current directory of the daemon
+    argv = list(argv)
+    for i, arg in enumerate(argv):
+        if arg == '--config-dir' and i + 1 < len(argv):
+            argv[i + 1] = os.path.abspath(argv[i + 1])
+        elif arg.startswith('--config-dir='):
+            argv[i] = '--config-dir=' + os.path.abspath(arg[len('--config-dir='):])
+    return argv
+
+def _connect(path):
+    if not os.path.exists(socket_path(path)):
+        return None
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(path))
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def _send(sock, message):
+    import json
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+def _messages(sock):
+    import json
+    f = sock.makefile('rb')
+    for line in f:
+        yield json.loads(line.decode('utf-8'))
+
+def forward(argv):
+    """
+    Run the ccm command argv (without the program name) in the daemon of
+    its config directory if there is one running, with the environment and
+    current directory of this process. Returns the exit status of the
+    command, or None if it has to be run locally.
+    """
+    if len(argv) == 0:
+        return None
+    if argv[0].lower() not in FORWARDED_CLUSTER_CMDS and (len(argv) < 2 or argv[1].lower() not in FORWARDED_NODE_CMDS):
+        return None
+    sock = _connect(_config_dir(argv))
+    if sock is None:
+        return None
+    import socket
+    try:
+        _send(sock, { 'argv' : _absolute_config_dir(argv), 'cwd' : os.getcwd(), 'env' : dict(os.environ) })
+        for message in _messages(sock):
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+            elif 'local' in message:
+                return None
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+    # the daemon went away while running the command
+    print_("ccm daemon connection lost", file=sys.stderr)
+    return 1
+
+def stop(path):
+    """
+    Stop the daemon of the config directory path. Returns False if no daemon
+    was running.
+    """
+    sock = _connect(path)
+    if sock is None:
+        return False
+    try:
+        _send(sock, { 'stop' : True })
+        for message in _messages(sock):
+            pass
+    finally:
+        sock.close()
+    return True
+
+class _Output():
+    """
+    Stands for sys.stdout or sys.stderr in the daemon: writes of the threads
+    running a command go to its client, the others to the original stream.
+    """
+
+    def __init__(self, stream, kind):
+        self.stream = stream
+        self.kind = kind
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        import socket
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            return self.stream.write(data)
+        try:
+            _send(sock, { self.kind : data })
+        except socket.error:
+            pass
+
+    def flush(self):
+        if getattr(self.local, 'sock', None) is None:
+            self.stream.flush()
+
+class _ClusterCache():
+    """
+    The clusters loaded by the daemon, reloaded whenever their state files
+    are modified (by the daemon itself or another process).
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__clusters = {}
+
+    def get(self, path, name):
+        from ccmlib.cluster import Cluster
+        key = (os.path.abspath(path), name)
+        signature = self.__signature(key[0], name)
+        with self.__lock:
+            cached = self.__clusters.get(key)
+            if cached is None or cached[0] != signature:
+                cached = (signature, Cluster.load(path, name, lazy=True))
+                self.__clusters[key] = cached
+            return cached[1]
+
+    def __signature(self, path, name):
+        from ccmlib import common
+        cluster_path = os.path.join(path, name)
+        files = [ os.path.join(cluster_path, common.CLUSTER_STATE), os.path.join(cluster_path, common.CLUSTER_CONF) ]
+        if os.path.isdir(cluster_path):
+            files += [ os.path.join(cluster_path, entry, common.NODE_CONF) for entry in sorted(os.listdir(cluster_path)) ]
+        signature = []
+        for filename in files:
+            try:
+                st = os.stat(filename)
+                signature.append((filename, st.st_mtime, st.st_size))
+            except OSError:
+                pass
+        return signature
+
+class Daemon():
+    """
+    Keeps the clusters of a config directory (and thus their nodes, log
+    buses, ...) loaded, and runs the ccm commands forwarded by the ccm
+    script over a unix socket. Commands run one at a time (they share the
+    cached cluster objects), each in the environment and current directory
+    of the ccm process that forwarded it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cache = _ClusterCache()
+        self.__lock = threading.Lock()
+        self.__sock = None
+        self.__stopped = threading.Event()
+
+    def serve(self):
+        import socket
+        from ccmlib.cmds.command import Cmd
+        from ccmlib import common
+        if not hasattr(socket, 'AF_UNIX'):
+            raise common.CCMError("The ccm daemon requires unix sockets")
+        sock_file = socket_path(self.path)
+        if os.path.exists(sock_file):
+            if stop(self.path):
+                raise common.CCMError("A ccm daemon is already running for %s" % self.path)
+            os.remove(sock_file)
+
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the user may connect, from the moment the socket exists
+        umask = os.umask(0o177)
+        try:
+            self.__sock.bind(sock_file)
+        finally:
+            os.umask(umask)
+        self.__sock.listen(16)
+        self.__sock.settimeout(0.5)
+
+        Cmd.cluster_cache = self.cache
+        sys.stdout = _Output(sys.stdout, 'out')
+        sys.stderr = _Output(sys.stderr, 'err')
+        try:
+            while not self.__stopped.is_set():
+                try:
+                    conn, _ = self.__sock.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                thread = threading.Thread(target=self.__handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            sys.stdout = sys.stdout.stream
+            sys.stderr = sys.stderr.stream
+            Cmd.cluster_cache = None
+            self.__sock.close()
+            if os.path.exists(sock_file):
+                os.remove(sock_file)
+
+    def shutdown(self):
+        self.__stopped.set()
+
+    def __handle(self, conn):
+        import socket
+        try:
+            request = next(_messages(conn))
+            if request.get('stop'):
+                self.shutdown()
+                _send(conn, { 'exit' : 0 })
+                return
+            status = self.__run(conn, request['argv'], request.get('cwd'), request.get('env'))
+            _send(conn, { 'local' : True } if status is None else { 'exit' : status })
+        except (socket.error, ValueError, StopIteration):
+            pass
+        finally:
+            conn.close()
+
+    def __run(self, conn, argv, cwd, env):
+        from ccmlib.cmds import dispatch
+
+        if argv[0].lower() in dispatch.CLUSTER_CMDS:
+            kind, cmd_name, cmd_args, forwarded = 'cluster', argv[0].lower(), argv[1:], FORWARDED_CLUSTER_CMDS
+        else:
+            kind, cmd_name, cmd_args, forwarded = 'node', argv[1].lower(), [ argv[0] ] + argv[2:], FORWARDED_NODE_CMDS
+        if cmd_name not in forwarded:
+            return None
+        cmd = dispatch.get_command(kind, cmd_name)
+        if cmd is None:
+            return None
+
+        with self.__lock:
+            saved_cwd, saved_env = os.getcwd(), dict(os.environ)
+            try:
+                if cwd is not None:
+                    os.chdir(cwd)
+            except OSError:
+                # let the client deal with its current directory
+                return None
+            if env is not None:
+                os.environ.clear()
+                os.environ.update(env)
+            sys.stdout.local.sock = conn
+            sys.stderr.local.sock = conn
+            try:
+                parser = cmd.get_parser()
+                (options, args) = parser.parse_args(cmd_args)
+                cmd.validate(parser, options, args)
+                cmd.run()
+                return 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print_(e.code, file=sys.stderr)
+                return 1
+            except Exception:
+                import traceback
+                sys.stderr.write(traceback.format_exc())
+                return 1
+            finally:
+                sys.stdout.local.sock = None
+                sys.stderr.local.sock = None
+                os.environ.clear()
+                os.environ.update(saved_env)
+                os.chdir(saved_cwd)
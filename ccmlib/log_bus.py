@@ -0,0 +1,243 @@
+# shared tailing of the node logs of a cluster
+import re
+import sys
+import threading
+import time
+
+from six import print_, string_types
+
+from ccmlib.log_watcher import LogMark, LogTail, LogWatcher
+from ccmlib.node import TimeoutError
+
+class LogFuture():
+    """
+    The pending result of a LogBus subscription. Once all the expressions
+    have been found, result() returns what Node.watch_log_for would have
+    returned: a (line, match) pair for a single expression, a list of such
+    pairs otherwise.
+
+    With addresses, exprs is a single expression with an 'address' group,
+    and the future completes once it has matched each of the addresses;
+    result() then returns the list of the matching (line, match) pairs.
+    """
+
+    def __init__(self, node, exprs, start, callback=None, addresses=None):
+        self.node = node
+        self.exprs = exprs
+        self.start = start
+        self.callback = callback
+        # set once the log reader has reached start
+        self._active = False
+        self.__tofind = [exprs] if isinstance(exprs, string_types) else list(exprs)
+        self.__tofind = [ re.compile(e) for e in self.__tofind ]
+        self.__addresses = None if addresses is None else set(addresses)
+        self.__matchings = []
+        self.__event = threading.Event()
+        if len(self.__tofind) == 0 or self.__addresses is not None and len(self.__addresses) == 0:
+            self.__event.set()
+
+    def done(self):
+        return self.__event.is_set()
+
+    def result(self, timeout=600):
+        """
+        Wait for at most timeout seconds for all the expressions to be found.
+        Raises a TimeoutError if they haven't been.
+        """
+        self.__event.wait(timeout)
+        if not self.__event.is_set():
+            missing = sorted(self.__addresses) if self.__addresses is not None else [e.pattern for e in self.__tofind]
+            raise TimeoutError(time.strftime("%d %b %Y %H:%M:%S", time.gmtime()) + " [" + self.node.name + "] Missing: " + str(missing))
+        if self.__addresses is not None:
+            return self.__matchings
+        if len(self.__matchings) == 0:
+            return None
+        return self.__matchings[0] if isinstance(self.exprs, string_types) else self.__matchings
+
+    def _feed(self, line):
+        # Returns True once this future is complete. The callback is left to
+        # _notify(), for the reader to call it without holding its lock
+        if self.__addresses is not None:
+            m = self.__tofind[0].search(line)
+            if m and m.group('address') in self.__addresses:
+                self.__matchings.append((line, m))
+                self.__addresses.discard(m.group('address'))
+            if len(self.__addresses) > 0:
+                return False
+            self.__event.set()
+            return True
+
+        for e in list(self.__tofind):
+            m = e.search(line)
+            if m:
+                self.__matchings.append((line, m))
+                self.__tofind.remove(e)
+        if len(self.__tofind) > 0:
+            return False
+
+        self.__event.set()
+        return True
+
+    def _notify(self):
+        if self.callback is not None:
+            try:
+                self.callback(self.result(0))
+            except Exception as e:
+                print_("[%s] Error in log callback: %s" % (self.node.name, str(e)), file=sys.stderr)
+
+class _LogReader():
+    """
+    Tails the log of one node in a background thread and feeds every line
+    to the futures subscribed to that node.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.lock = threading.Lock()
+        self.futures = []
+        self.tail = None
+        self.position = None
+        # a mark in each of the log files read so far, as the log gets rotated
+        self.files = []
+        self.closed = False
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+
+    def subscribe(self, future):
+        completed = False
+        with self.lock:
+            if self.tail is None:
+                self.tail = LogTail(self.node.logfilename(), future.start)
+                self.position = self.tail.mark()
+                future._active = True
+                self.thread.start()
+            elif self.__is_behind(future.start):
+                # The reader is already past the requested mark: go back and
+                # catch up on what has been read already for that future only
+                completed = self.__catch_up(future)
+                future._active = True
+            if not completed:
+                self.futures.append(future)
+        if completed:
+            future._notify()
+
+    def unsubscribe(self, future):
+        with self.lock:
+            if future in self.futures:
+                self.futures.remove(future)
+
+    def __is_behind(self, start):
+        if start.inode is None or self.position.inode is None or start.same_file(self.position):
+            return start < self.position
+        # a mark in a log file this reader is done with
+        return any(start.same_file(mark) for mark in self.files)
+
+    def __catch_up(self, future):
+        with LogTail(self.node.logfilename(), future.start) as tail:
+            while True:
+                mark = tail.mark()
+                if mark.same_file(self.position) and mark >= self.position:
+                    break
+                line = tail.readline()
+                if not line:
+                    break
+                if future._feed(line.decode('utf-8', 'replace')):
+                    return True
+        return False
+
+    def __run(self):
+        with LogWatcher(self.node.logfilename()) as watcher:
+            while not self.closed:
+                line = self.tail.readline()
+                if not line:
+                    watcher.wait(.5)
+                    continue
+                watcher.reset()
+                decoded = line.decode('utf-8', 'replace')
+                completed = []
+                with self.lock:
+                    position = self.tail.mark()
+                    if not position.same_file(self.position):
+                        self.files.append(position)
+                    self.position = position
+                    offset = self.position - len(line)
+                    for future in list(self.futures):
+                        if not future._active:
+                            # waiting for the reader to reach its mark
+                            if (future.start.inode is not None and not future.start.same_file(self.position)) or offset < future.start:
+                                continue
+                            future._active = True
+                        if future._feed(decoded):
+                            self.futures.remove(future)
+                            completed.append(future)
+                # callbacks may subscribe again
+                for future in completed:
+                    future._notify()
+            self.tail.close()
+
+class LogBus():
+    """
+    Tails the log of each node of a cluster once, in a background thread per
+    node, and dispatches log lines to subscribers. This allows many
+    concurrent waits on many nodes (gossip, CQL readiness, compactions, ...)
+    to share a single pass over each log:
+
+        bus = cluster.log_bus()
+        futures = [ bus.subscribe(node, "Starting listening for CQL clients", from_mark=mark) for node, mark in marks ]
+        for future in futures:
+            future.result(timeout=120)
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__readers = {}
+
+    def subscribe(self, node, exprs, from_mark=None, callback=None):
+        """
+        Watch the log of node, from the mark (as returned by Node.mark_log())
+        or from the beginning, until one or more (regular) expression are
+        found. Returns a LogFuture; if a callback is provided, it is called
+        with the result (from the reader thread) once everything was found.
+        """
+        start = from_mark if isinstance(from_mark, LogMark) else LogMark(from_mark or 0)
+        return self.__subscribe(LogFuture(node, exprs, start, callback))
+
+    def subscribe_addresses(self, node, template, nodes, from_mark=None, callback=None):
+        """
+        Like subscribe(), but for a message about each of the provided nodes,
+        like "%s.* now UP", in which the node address replaces the %s. A
+        single expression matches all the addresses, so that each line is
+        only searched once whatever the number of nodes.
+        """
+        start = from_mark if isinstance(from_mark, LogMark) else LogMark(from_mark or 0)
+        addresses = set([ other.address() for other in nodes ])
+        alternation = "|".join([ re.escape(a) for a in sorted(addresses, key=len, reverse=True) ])
+        expr = template % ("(?P<address>%s)(?![0-9])" % alternation)
+        return self.__subscribe(LogFuture(node, expr, start, callback, addresses=addresses))
+
+    def __subscribe(self, future):
+        node = future.node
+        if future.done():
+            return future
+        with self.__lock:
+            reader = self.__readers.get(node.logfilename())
+            if reader is None:
+                reader = _LogReader(node)
+                self.__readers[node.logfilename()] = reader
+        reader.subscribe(future)
+        return future
+
+    def unsubscribe(self, future):
+        with self.__lock:
+            reader = self.__readers.get(future.node.logfilename())
+        if reader is not None:
+            reader.unsubscribe(future)
+
+    def close(self):
+        """
+        Stop all the reader threads. Pending futures will never complete.
+        """
+        with self.__lock:
+            for reader in self.__readers.values():
+                reader.closed = True
+            self.__readers = {}
@@ -0,0 +1,150 @@
+# sparse index from timestamps to offsets in node log files
+import binascii
+import datetime
+import os
+import re
+
+from six import string_types
+
+from ccmlib import common
+
+INDEX_SUFFIX = ".idx"
+# bytes of log between two entries of the index
+INDEX_INTERVAL = 256 * 1024
+# bytes at the start of a log file that identify it along with its inode
+# (logback's rotation may give the inode of the old log to the new one)
+HEAD_SIZE = 128
+
+# the timestamp of a log4j or logback line of cassandra, as in:
+#  INFO [main] 2014-01-21 11:15:36,545 CassandraDaemon.java (line 101) ...
+# INFO  [main] 2014-01-21 11:15:36,545 CassandraDaemon.java:101 - ...
+LINE_TIMESTAMP = re.compile(br'\s*[A-Z]+\s+\[[^\]]*\]\s+(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})')
+TIMESTAMP = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(,\d{3})?$')
+
+def same_head(head, other):
+    """
+    Whether head and other, the first bytes of files read at different times
+    (so possibly while one was shorter than HEAD_SIZE), can be the first
+    bytes of the same file.
+    """
+    if head is None or other is None:
+        return True
+    return head.startswith(other) or other.startswith(head)
+
+def line_timestamp(line):
+    """
+    Returns the timestamp of a log line (as bytes) as a string like
+    '2014-01-21 11:15:36,545', or None if it has none (stack traces, ...).
+    """
+    m = LINE_TIMESTAMP.match(line)
+    return m.group(1).decode('ascii') if m else None
+
+def to_timestamp(value):
+    """
+    Converts a datetime or a 'YYYY-MM-DD HH:MM:SS[,mmm]' string to a
+    timestamp comparable with the ones of line_timestamp().
+    """
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S,') + '%03d' % (value.microsecond // 1000)
+    if isinstance(value, string_types) and TIMESTAMP.match(value.strip()):
+        value = value.strip()
+        return value if ',' in value else value + ',000'
+    raise common.ArgumentError("Invalid log timestamp %s, expecting 'YYYY-MM-DD HH:MM:SS[,mmm]'" % str(value))
+
+class LogIndex():
+    """
+    Sparse index of a log file, stored beside it (as system.log.idx for
+    system.log): the offset and timestamp of a line every INDEX_INTERVAL
+    bytes. It is brought up to date with what has been logged since its last
+    use each time it is used, and rebuilt when the log has been rotated
+    (when its inode or its first bytes changed).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + INDEX_SUFFIX
+        self.__entries = []
+
+    def offset(self, since):
+        """
+        Returns the offset of the first line of the log with a timestamp at
+        or after since (a datetime or a timestamp string), or the size of the
+        log if there is none.
+        """
+        since = to_timestamp(since)
+        with open(self.filename, 'rb') as f:
+            self.__update(f)
+            start = 0
+            for offset, timestamp in self.__entries:
+                if timestamp >= since:
+                    break
+                start = offset
+            f.seek(start)
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    return start
+                timestamp = line_timestamp(line)
+                if timestamp is not None and timestamp >= since:
+                    return start
+                start += len(line)
+
+    def end_offset(self, until):
+        """
+        Returns an offset of the log after which all lines are timestamped
+        after until: the offset of the first index entry past until, or the
+        size of the log.
+        """
+        until = to_timestamp(until)
+        with open(self.filename, 'rb') as f:
+            end = self.__update(f)
+        for offset, timestamp in self.__entries:
+            if timestamp > until:
+                return offset
+        return end
+
+    def __update(self, f):
+        # Loads the index and indexes what has been logged since it was last
+        # saved. Returns the end of the indexed part of the log.
+        st = os.fstat(f.fileno())
+        head = f.read(HEAD_SIZE)
+        inode, end, saved_head, entries = self.__load()
+        if inode != st.st_ino or end > st.st_size or not same_head(saved_head, head):
+            inode, end, entries = st.st_ino, 0, []
+        saved_end = end
+
+        f.seek(end)
+        next_entry = entries[-1][0] + INDEX_INTERVAL if entries else 0
+        while True:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                break
+            if end >= next_entry:
+                timestamp = line_timestamp(line)
+                if timestamp is not None:
+                    entries.append((end, timestamp))
+                    next_entry = end + INDEX_INTERVAL
+            end += len(line)
+
+        self.__entries = entries
+        if end != saved_end:
+            content = "%d %d %s\n" % (inode, end, binascii.hexlify(head).decode('ascii')) + "".join([ "%d %s\n" % entry for entry in entries ])
+            try:
+                common.write_file_atomically(self.index_filename, content, sync=False)
+            except (IOError, OSError):
+                # the index is only a cache
+                pass
+        return end
+
+    def __load(self):
+        try:
+            with open(self.index_filename, 'r') as f:
+                lines = f.read().splitlines()
+            inode, end, head = lines[0].split()
+            entries = []
+            for line in lines[1:]:
+                offset, timestamp = line.split(' ', 1)
+                entries.append((int(offset), timestamp))
+            return int(inode), int(end), binascii.unhexlify(head), entries
+        except (IOError, OSError, IndexError, ValueError, TypeError, binascii.Error):
+            return None, 0, None, []
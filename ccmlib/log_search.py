@@ -0,0 +1,268 @@
+# searching node log files
+import mmap
+import os
+import re
+
+from ccmlib.log_index import LogIndex, line_timestamp, to_timestamp
+
+# bytes of log searched at once
+CHUNK_SIZE = 4 * 1024 * 1024
+# bytes of log per matching line under which all the lines are searched
+DENSE_MATCHES = 1024
+# bytes on which a regular expression on bytes doesn't behave like on the
+# decoded text: UTF-8 sequences (one character for ., \w, IGNORECASE, ...)
+# and the separators str considers whitespace but bytes don't
+UNSAFE_BYTES = re.compile(b'[\x1c-\x1f\x80-\xff]')
+# what refers to the start or end of the searched text (or what precedes
+# it), which is a line when searching lines but not when prefiltering chunks
+TEXT_BOUNDS = re.compile(br'\\[AZz]|\(\?<[=!]')
+
+def bytes_pattern(pattern):
+    """
+    Returns a bytes version of the compiled regular expression pattern, to
+    find candidate lines without decoding the whole log, or None if it can't
+    be expressed on bytes or has TEXT_BOUNDS. It only finds the same lines
+    as pattern on chunks of log without UNSAFE_BYTES (see prefilter()).
+    """
+    expr = pattern.pattern
+    if not isinstance(expr, bytes):
+        try:
+            expr = expr.encode('ascii')
+        except UnicodeError:
+            return None
+    if TEXT_BOUNDS.search(expr):
+        return None
+    try:
+        return re.compile(expr, (pattern.flags & ~re.UNICODE) | re.MULTILINE)
+    except (re.error, ValueError):
+        return None
+
+def prefilter(chunk, pattern):
+    """
+    Returns pattern (as returned by bytes_pattern()) if it can be used to
+    find the candidate lines of chunk, None if all the lines of chunk must
+    be searched.
+    """
+    if pattern is None or UNSAFE_BYTES.search(chunk):
+        return None
+    return pattern
+
+def _timestamp_at(buf, line_start, line):
+    # lines without timestamp (stack traces, ...) go with the line before
+    timestamp = line_timestamp(line)
+    while timestamp is None and line_start > 0:
+        previous = buf.rfind(b'\n', 0, line_start - 1) + 1
+        timestamp = line_timestamp(buf[previous:line_start])
+        line_start = previous
+    return timestamp
+
+def grep_buffer(buf, pattern, start=0, end=None, until=None):
+    """
+    Yields the (line, match object) pairs of the lines of buf (log content as
+    bytes, or a mmap) between the offsets start (the start of a line) and end
+    matching the compiled regular expression pattern. The search runs on the
+    bytes, a large chunk of lines at a time, and only the lines that match
+    get decoded. If until (a timestamp as returned by log_index.to_timestamp())
+    is provided, the lines logged after it are skipped.
+    """
+    end = len(buf) if end is None else min(end, len(buf))
+    candidates = bytes_pattern(pattern)
+    while start < end:
+        chunk_end = end
+        if end - start > CHUNK_SIZE:
+            # whole lines only
+            chunk_end = buf.rfind(b'\n', start, start + CHUNK_SIZE) + 1 or end
+        chunk = buf[start:chunk_end]
+        for line_start, line in _candidate_lines(chunk, prefilter(chunk, candidates)):
+            if until is not None:
+                timestamp = _timestamp_at(buf, start + line_start, line)
+                if timestamp is not None and timestamp > until:
+                    continue
+            line = line.decode('utf-8', 'replace')
+            m = pattern.search(line)
+            if m:
+                yield line, m
+        start = chunk_end
+
+def _candidate_lines(chunk, prefilter):
+    # The (offset, line) of the lines of chunk matching prefilter. When most
+    # lines match, going from match to match costs more than taking all the
+    # lines of the rest of the chunk at once.
+    pos, end, count = 0, len(chunk), 0
+    while prefilter is not None and pos < end:
+        m = prefilter.search(chunk, pos)
+        if m is None:
+            return
+        line_start = chunk.rfind(b'\n', pos, m.start()) + 1 or pos
+        line_end = chunk.find(b'\n', line_start)
+        pos = end if line_end < 0 else line_end + 1
+        yield line_start, chunk[line_start:pos]
+        count += 1
+        if count * DENSE_MATCHES > pos:
+            break
+    lines = chunk[pos:].split(b'\n')
+    for line in lines[:-1]:
+        yield pos, line + b'\n'
+        pos += len(line) + 1
+    if lines[-1]:
+        yield pos, lines[-1]
+
+def grep_file(filename, pattern, start=0, end=None, until=None):
+    """
+    grep_buffer() on the content of filename, which is memory mapped.
+    """
+    with open(filename, 'rb') as f:
+        if start >= os.fstat(f.fileno()).st_size:
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for matching in grep_buffer(buf, pattern, start, end, until):
+                yield matching
+        finally:
+            buf.close()
+
+def grep_stream(stream, pattern, since=None, until=None):
+    """
+    Same as grep_buffer(), on the content of a binary stream (such as a
+    compressed log archive) read a chunk at a time. The lines logged before
+    since or after until (timestamps as returned by to_timestamp()) are
+    skipped.
+    """
+    candidates = bytes_pattern(pattern)
+    rest = b""
+    # the timestamp of the last timestamped line of the previous chunks
+    previous = None
+    while True:
+        data = stream.read(CHUNK_SIZE)
+        chunk, rest = rest + data, b""
+        if data:
+            # whole lines only
+            cut = chunk.rfind(b'\n') + 1
+            chunk, rest = chunk[:cut], chunk[cut:]
+        for line_start, line in _candidate_lines(chunk, prefilter(chunk, candidates)):
+            if since is not None or until is not None:
+                timestamp = _timestamp_at(chunk, line_start, line) or previous
+                if timestamp is not None and ((since is not None and timestamp < since) or (until is not None and timestamp > until)):
+                    continue
+            line = line.decode('utf-8', 'replace')
+            m = pattern.search(line)
+            if m:
+                yield line, m
+        if not data:
+            return
+        if chunk and (since is not None or until is not None):
+            last_line = chunk.rfind(b'\n', 0, len(chunk) - 1) + 1
+            previous = _timestamp_at(chunk, last_line, chunk[last_line:]) or previous
+
+def rotated_logs(filename):
+    """
+    Returns the archives left by the rotations of the log filename (as
+    system.log.1.zip, system.log.2.zip, ... with logback, or system.log.1,
+    ... with log4j), newest first.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    pattern = re.compile(re.escape(name) + r'\.(\d+)(\.zip|\.gz)?$')
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return []
+    archives = []
+    for entry in entries:
+        m = pattern.match(entry)
+        if m:
+            archives.append((int(m.group(1)), os.path.join(directory, entry)))
+    return [ path for _, path in sorted(archives) ]
+
+def open_archive(path):
+    """
+    Returns a binary stream on the content of a log archive, decompressed on
+    the fly (rather than extracted to disk) if need be.
+    """
+    if path.endswith('.zip'):
+        import zipfile
+        try:
+            archive = zipfile.ZipFile(path)
+        except zipfile.BadZipfile as e:
+            # possibly still being written
+            raise IOError("Invalid log archive %s: %s" % (path, str(e)))
+        try:
+            names = archive.namelist()
+            if len(names) == 0:
+                import io
+                return io.BytesIO(b"")
+            # the member keeps the archive file open
+            return archive.open(names[0])
+        finally:
+            archive.close()
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _grep_live(filename, pattern, since, until):
+    start, end = 0, None
+    if since is not None or until is not None:
+        index = LogIndex(filename)
+        if since is not None:
+            start = index.offset(since)
+        if until is not None:
+            end = index.end_offset(until)
+            until = to_timestamp(until)
+    return grep_file(filename, pattern, start, end, until)
+
+def _grep_archive(path, pattern, since, until):
+    since = to_timestamp(since) if since is not None else None
+    until = to_timestamp(until) if until is not None else None
+    try:
+        stream = open_archive(path)
+    except (IOError, OSError):
+        # rotated away, or still being written
+        return
+    try:
+        for matching in grep_stream(stream, pattern, since, until):
+            yield matching
+    finally:
+        stream.close()
+
+def grep_log(filename, pattern, since=None, until=None, max_matches=None, archives=True, newest_first=False):
+    """
+    Yields the (line, match object) pairs of the lines of the log filename
+    matching the compiled regular expression pattern, only in the window
+    between since and until if provided (using the LogIndex of the log to
+    get there), and at most max_matches of them if provided. Unless archives
+    is False, the archives of the log (see rotated_logs()) are searched too.
+    Lines come in the order they were logged, or newest first.
+    """
+    if max_matches is not None and max_matches <= 0:
+        return
+    paths = [ filename ]
+    if archives:
+        paths = list(reversed(rotated_logs(filename))) + paths
+    if newest_first:
+        paths.reverse()
+    count = 0
+    for path in paths:
+        if path == filename:
+            if len(paths) > 1 and not os.path.exists(filename):
+                # rotated, and not recreated yet
+                continue
+            matchings = _grep_live(filename, pattern, since, until)
+        else:
+            matchings = _grep_archive(path, pattern, since, until)
+        if newest_first:
+            matchings = reversed(list(matchings))
+        for matching in matchings:
+            yield matching
+            count += 1
+            if count == max_matches:
+                return
+
+def grep_log_lines(args):
+    """
+    grep_log() for a process pool: takes (filename, expr, flags, since,
+    until, max_matches, archives, newest_first) and returns filename with
+    the list of the matching lines, as match objects can't be sent back to
+    the parent process.
+    """
+    filename, expr, flags = args[:3]
+    return filename, [ line for line, _ in grep_log(filename, re.compile(expr, flags), *args[3:]) ]
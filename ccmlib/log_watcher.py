@@ -0,0 +1,314 @@
+# waiting for changes in node log files
+import errno
+import os
+import select
+import sys
+import time
+
+from ccmlib.log_index import HEAD_SIZE, same_head
+from ccmlib.log_search import open_archive, rotated_logs
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+MIN_POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.5
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+def _inotify_watch(directory):
+    """
+    Returns an inotify file descriptor watching directory for new or modified
+    files, or None if inotify is not available.
+    """
+    if not sys.platform.startswith('linux') or not os.path.isdir(directory):
+        return None
+    try:
+        libc = _get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, directory.encode(sys.getfilesystemencoding()), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+class LogMark(int):
+    """
+    A position in a log file, as returned by Node.mark_log(): an offset
+    (this is an int) along with the inode and the first bytes of the file it
+    is an offset in, so that a rotation of the log after the mark can be
+    detected. The first bytes tell a new log apart from the old one when it
+    reuses its inode, as happens when logback compresses the old log into an
+    archive, deletes it and creates the new log.
+    """
+
+    def __new__(cls, offset, inode=None, head=None):
+        mark = int.__new__(cls, offset)
+        mark.inode = inode
+        mark.head = head
+        return mark
+
+    def __repr__(self):
+        return "LogMark(%d, %s)" % (self, self.inode)
+
+    def same_file(self, other):
+        """
+        Whether other (a LogMark) is a position in the same log file.
+        """
+        if self.inode is None or self.inode != other.inode:
+            return False
+        return same_head(self.head, other.head)
+
+def _read_head(f):
+    pos = f.tell()
+    f.seek(0)
+    head = f.read(HEAD_SIZE)
+    f.seek(pos)
+    return head
+
+def file_mark(filename, offset=None):
+    """
+    Returns the LogMark of offset (or of the end of the file if None) in the
+    log filename, or LogMark(0) if it doesn't exist.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            head = f.read(HEAD_SIZE)
+    except (IOError, OSError):
+        return LogMark(0)
+    return LogMark(st.st_size if offset is None else offset, st.st_ino, head)
+
+def _find_file(filename, mark):
+    # The uncompressed archive of the log filename the mark is in, if it
+    # still exists. Compressed archives are new files (that may even have
+    # reused the inode of the log they were made from).
+    for path in rotated_logs(filename):
+        if path.endswith('.zip') or path.endswith('.gz'):
+            continue
+        if mark.same_file(file_mark(path, 0)):
+            return path
+    return None
+
+class LogTail():
+    """
+    Reads the lines of a log file from a mark, following the rotations of
+    the file: once it is replaced by a new one (or truncated), what is left
+    of the old file is read before continuing at the start of the new one.
+    If the mark is in a file that has been rotated away already, that file
+    is read from the mark if it can still be found (renamed), or else the
+    newest archive of the log (see log_search.rotated_logs()). Without mark,
+    the archives of the log are read first (oldest first) if archives is
+    True.
+    """
+
+    def __init__(self, filename, mark=None, archives=False):
+        self.filename = filename
+        self.__file = None
+        self.__inode = None
+        self.__head = None
+        self.__partial = b""
+        self.__draining = False
+        self.__start = mark if isinstance(mark, LogMark) else LogMark(mark or 0)
+        # (path, offset) of the archives to read before the log
+        self.__archives = []
+        self.__archive = None
+        if mark is None and archives:
+            self.__archives = [ (path, 0) for path in reversed(rotated_logs(filename)) ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if self.__archive is not None:
+            self.__archive.close()
+            self.__archive = None
+
+    def mark(self):
+        """
+        Returns the LogMark of the end of the last line returned.
+        """
+        if self.__file is None:
+            return self.__start
+        if len(self.__head) < HEAD_SIZE:
+            # the file was shorter than that when opened
+            self.__head = _read_head(self.__file)
+        return LogMark(self.__file.tell() - len(self.__partial), self.__inode, self.__head)
+
+    def readline(self):
+        """
+        Returns the next complete line (as bytes), or an empty string if
+        there is none yet. The last line of a rotated file is returned even
+        if it isn't terminated by a newline, as it will never be.
+        """
+        while True:
+            line = self.__read_archives()
+            if line:
+                return line
+            if self.__file is None and not self.__open():
+                return b""
+            if len(self.__archives) > 0:
+                # the mark is in an archive
+                continue
+            line = self.__file.readline()
+            if line:
+                line = self.__partial + line
+                if line.endswith(b"\n"):
+                    self.__partial = b""
+                    return line
+                # the rest of that line hasn't been written yet
+                self.__partial = line
+            if not self.__draining:
+                if not self.__replaced():
+                    return b""
+                # read once more what may have been written to the old file
+                # between the end of the previous read and the rotation
+                self.__draining = True
+                continue
+            if self.__partial:
+                line, self.__partial = self.__partial, b""
+                return line
+            # done with the old file
+            self.__file.close()
+            self.__file = None
+            self.__draining = False
+            self.__start = LogMark(0)
+
+    def __read_archives(self):
+        while self.__archive is not None or len(self.__archives) > 0:
+            if self.__archive is None:
+                path, offset = self.__archives.pop(0)
+                try:
+                    self.__archive = open_archive(path)
+                except (IOError, OSError):
+                    # rotated away (or still being written)
+                    continue
+                while offset > 0:
+                    skipped = len(self.__archive.read(min(offset, 1024 * 1024)))
+                    if skipped == 0:
+                        break
+                    offset -= skipped
+            line = self.__archive.readline()
+            if line:
+                return line
+            self.__archive.close()
+            self.__archive = None
+        return b""
+
+    def __replaced(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            # rotated away, and the new file isn't there yet
+            return False
+        return st.st_ino != self.__inode or st.st_size < self.__file.tell()
+
+    def __open(self):
+        filename, start = self.filename, self.__start
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if start.inode is not None and not start.same_file(file_mark(filename)):
+            # the log was rotated after the mark
+            filename = _find_file(filename, start)
+            if filename is None:
+                # most likely compressed into the newest archive
+                archives = rotated_logs(self.filename)
+                if len(archives) > 0 and (archives[0].endswith('.zip') or archives[0].endswith('.gz')):
+                    self.__archives = [ (archives[0], int(start)) ]
+                filename, start = self.filename, 0
+        elif start > st.st_size:
+            # an offset without inode in a file that has been replaced since
+            start = 0
+        try:
+            self.__file = open(filename, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        self.__inode = os.fstat(self.__file.fileno()).st_ino
+        self.__head = _read_head(self.__file)
+        self.__file.seek(start)
+        return True
+
+class LogWatcher():
+    """
+    Waits for new data in a log file. On Linux this relies on inotify so
+    that waiters are woken up as soon as something gets written to the file
+    (or the file gets created). Elsewhere, the file is polled with an interval
+    that starts at a few milliseconds and grows while nothing happens.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__fd = _inotify_watch(os.path.dirname(os.path.abspath(filename)))
+        self.__poll_interval = MIN_POLL_INTERVAL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def uses_inotify(self):
+        return self.__fd is not None
+
+    def reset(self):
+        """
+        To be called when new data has been read, so that polling resumes at
+        its fastest pace.
+        """
+        self.__poll_interval = MIN_POLL_INTERVAL
+
+    def wait(self, timeout):
+        """
+        Wait for at most timeout seconds for the log directory to change.
+        Returns True if a change was notified (always False when polling).
+        """
+        if self.__fd is None:
+            time.sleep(max(0, min(timeout, self.__poll_interval)))
+            self.__poll_interval = min(self.__poll_interval * 2, MAX_POLL_INTERVAL)
+            return False
+
+        try:
+            readable, _, _ = select.select([ self.__fd ], [], [], max(0, timeout))
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        try:
+            while os.read(self.__fd, 65536):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
@@ -4,7 +4,6 @@ from __future__ import with_statement
 from six import print_, iteritems, string_types
 from six.moves import xrange
 
-import errno
 import glob
 import os
 import re
@@ -13,11 +12,13 @@ import signal
 import stat
 import subprocess
 import sys
+import threading
 import time
-import yaml
 
-from ccmlib.repository import setup
 from ccmlib.cli_session import CliSession
+from ccmlib.log_index import LogIndex
+from ccmlib.log_search import grep_log
+from ccmlib.log_watcher import LogTail, LogWatcher, file_mark
 from ccmlib import common
 
 class Status():
@@ -35,6 +36,13 @@ class TimeoutError(Exception):
     def __init__(self, data):
         Exception.__init__(self, str(data))
 
+# How long (in seconds) a probed node status is trusted before probing again
+STATUS_CACHE_TTL = 0.5
+
+# How long (in seconds) a stopping node is waited for before being killed:
+# as long as ccm used to wait for it (1 + 2 + ... + 64s)
+STOP_TIMEOUT = 127
+
 # Groups: 1 = cf, 2 = tmp or none, 3 = suffix (Compacted or Data.db)
 _sstable_regexp = re.compile('(?P<cf>[\S]+)+-(?P<tmp>tmp-)?[\S]+-(?P<suffix>[a-zA-Z.]+)')
 
@@ -66,11 +74,15 @@ class Node():
         self.remote_debug_port = remote_debug_port
         self.initial_token = initial_token
         self.pid = None
+        self.__pid_start_time = None
         self.data_center = None
         self.__config_options = {}
         self.__cassandra_dir = None
         self.__global_log_level = None
         self.__classes_log_level = {}
+        # when the status was last probed, and what node.conf last recorded
+        self.__status_time = 0
+        self.__saved_status = (self.status, self.pid)
         if save:
             self.import_config_files()
             self.import_bin_files()
@@ -78,15 +90,17 @@ class Node():
                 self.__clean_bat()
 
     @staticmethod
-    def load(path, name, cluster):
+    def load(path, name, cluster, data=None):
         """
         Load a node from from the path on disk to the config files, the node name and the
-        cluster the node is part of.
+        cluster the node is part of. If the cluster keeps its state in a single
+        file, data is the node entry of that file.
         """
         node_path = os.path.join(path, name)
-        filename = os.path.join(node_path, 'node.conf')
-        with open(filename, 'r') as f:
-            data = yaml.load(f)
+        filename = os.path.join(node_path, common.NODE_CONF)
+        if data is None:
+            with open(filename, 'r') as f:
+                data = common.load_yaml(f)
         try:
             itf = data['interfaces']
             initial_token = None
@@ -102,16 +116,42 @@ class Node():
             node.status = data['status']
             if 'pid' in data:
                 node.pid = int(data['pid'])
+            if 'pid_start_time' in data:
+                node.__pid_start_time = data['pid_start_time']
             if 'cassandra_dir' in data:
                 node.__cassandra_dir = data['cassandra_dir']
             if 'config_options' in data:
                 node.__config_options = data['config_options']
             if 'data_center' in data:
                 node.data_center = data['data_center']
+            node.__saved_status = (node.status, node.pid)
             return node
         except KeyError as k:
             raise common.LoadError("Error Loading " + filename + ", missing property: " + str(k))
 
+    def clone(self, name, auto_bootstrap, thrift_interface, storage_interface, jmx_port, remote_debug_port, initial_token, binary_interface=None):
+        """
+        Create a new node of the same cluster from this (fully prepared) node,
+        by copying its config and bin files rather than importing them again
+        from the cassandra directory. The parameters are the same as for
+        Node(). The node specific settings of the copied files still need to
+        be updated, which Cluster.add does.
+        """
+        node = Node(name, self.cluster, auto_bootstrap, thrift_interface, storage_interface, jmx_port, remote_debug_port, initial_token, save=False, binary_interface=binary_interface)
+        node.__config_options = dict(self.__config_options)
+        node.__cassandra_dir = self.__cassandra_dir
+        node.__global_log_level = self.__global_log_level
+        node.__classes_log_level = dict(self.__classes_log_level)
+        node.__update_config()
+        for src_dir, dst_dir, hardlink in [ (self.get_conf_dir(), node.get_conf_dir(), common.hardlink_conf_files()), (self.get_bin_dir(), node.get_bin_dir(), True) ]:
+            for name in os.listdir(src_dir):
+                filename = os.path.join(src_dir, name)
+                if os.path.isfile(filename):
+                    common.link_or_copy(filename, dst_dir, hardlink)
+        if common.is_win():
+            node.__clean_bat()
+        return node
+
     def get_path(self):
         """
         Returns the path to this node top level directory (where config/data is stored)
@@ -155,6 +195,7 @@ class Node():
             if cassandra_dir is not None:
                 common.validate_cassandra_dir(cassandra_dir)
         else:
+            from ccmlib.repository import setup
             dir, v = setup(cassandra_version, verbose=verbose)
             self.__cassandra_dir = dir
         self.import_config_files()
@@ -227,31 +268,55 @@ class Node():
         """
         return os.path.join(self.get_path(), 'logs', 'system.log')
 
-    def grep_log(self, expr):
+    def grep_log(self, expr, since=None, until=None, archives=True, newest_first=False):
         """
         Returns a list of lines matching the regular expression in parameter
-        in the Cassandra log of this node
+        in the Cassandra log of this node, including the archives left by its
+        rotations unless archives is False. Lines are in the order they were
+        logged, or newest first. If since and/or until (datetimes or
+        'YYYY-MM-DD HH:MM:SS[,mmm]' strings) are provided, only the lines
+        logged in that window are searched: a sparse index of the log (see
+        LogIndex) allows to read only that part of the log.
         """
-        matchings = []
-        pattern = re.compile(expr)
-        with open(self.logfilename()) as f:
-            for line in f:
-                m = pattern.search(line)
-                if m:
-                    matchings.append((line, m))
-        return matchings
+        return list(self.grep_log_iter(expr, since, until, archives=archives, newest_first=newest_first))
 
-    def mark_log(self):
+    def grep_log_iter(self, expr, since=None, until=None, max_matches=None, archives=True, newest_first=False):
+        """
+        Same as grep_log(), but yields the (line, match object) pairs as they
+        are found, stopping after max_matches of them if provided. The log is
+        memory mapped and searched as bytes: only matching lines get decoded.
+        Compressed archives are decompressed as they are read.
+        """
+        return grep_log(self.logfilename(), re.compile(expr), since, until, max_matches, archives, newest_first)
+
+    def mark_log(self, since=None):
         """
         Returns "a mark" to the current position of this node Cassandra log.
         This is for use with the from_mark parameter of watch_log_for_* methods,
         allowing to watch the log from the position when this method was called.
+        The mark is a LogMark (an int offset that also records the identity
+        of the log file), so that watching from it follows a rotation of the
+        log.
+        If since (a datetime or a 'YYYY-MM-DD HH:MM:SS[,mmm]' string) is
+        provided, the mark is to the first line logged at or after it instead.
+        """
+        if since is not None and os.path.exists(self.logfilename()):
+            return file_mark(self.logfilename(), LogIndex(self.logfilename()).offset(since))
+        return file_mark(self.logfilename())
+
+    def _drain_output(self, process, verbose=False):
+        """
+        Read the standard output of the Cassandra process in a background
+        thread (printing it if verbose): Cassandra logs to it until it is
+        started, and would block once the pipe is full if nobody reads it.
         """
-        if not os.path.exists(self.logfilename()):
-            return 0
-        with open(self.logfilename()) as f:
-            f.seek(0, os.SEEK_END)
-            return f.tell()
+        def drain():
+            for line in process.stdout:
+                if verbose:
+                    print_(line.decode('utf-8', 'replace').rstrip('\n'))
+        thread = threading.Thread(target=drain)
+        thread.daemon = True
+        thread.start()
 
     def print_process_output(self, name, proc, verbose=False):
         if verbose:
@@ -269,59 +334,54 @@ class Node():
         timeouts (a TimeoutError is then raised). On successful completion,
         a list of pair (line matched, match object) is returned.
         """
-        elapsed = 0
         tofind = [exprs] if isinstance(exprs, string_types) else exprs
         tofind = [ re.compile(e) for e in tofind ]
         matchings = []
-        reads = ""
         if len(tofind) == 0:
             return None
 
-        while not os.path.exists(self.logfilename()):
-            time.sleep(.5)
-            if process:
-                process.poll()
-                if process.returncode is not None:
-                    self.print_process_output(self.name, process, verbose)
-                    if process.returncode != 0:
-                        raise RuntimeError() # Shouldn't reuse RuntimeError but I'm lazy
+        def on_line(line):
+            for e in list(tofind):
+                m = e.search(line)
+                if m:
+                    matchings.append((line, m))
+                    tofind.remove(e)
+            return len(tofind) == 0
 
-        with open(self.logfilename()) as f:
-            if from_mark:
-                f.seek(from_mark)
+        if self.__watch_log(on_line, lambda: str([e.pattern for e in tofind]), from_mark, timeout, process, verbose):
+            return matchings[0] if isinstance(exprs, string_types) else matchings
+        return None
 
-            while True:
-                # First, if we have a process to check, then check it.
-                # Skip on Windows - stdout/stderr is cassandra.bat
-                if not common.is_win():
-                    if process:
-                        process.poll()
-                        if process.returncode is not None:
-                            self.print_process_output(self.name, process, verbose)
-                            if process.returncode != 0:
-                                raise RuntimeError() # Shouldn't reuse RuntimeError but I'm lazy
-
-                line = f.readline()
-                if line:
-                    reads = reads + line
-                    for e in tofind:
-                        m = e.search(line)
-                        if m:
-                            matchings.append((line, m))
-                            tofind.remove(e)
-                            if len(tofind) == 0:
-                                return matchings[0] if isinstance(exprs, string_types) else matchings
-                else:
-                    # yep, it's ugly
-                    time.sleep(1)
-                    elapsed = elapsed + 1
-                    if elapsed > timeout:
-                        raise TimeoutError(time.strftime("%d %b %Y %H:%M:%S", time.gmtime()) + " [" + self.name + "] Missing: " + str([e.pattern for e in tofind]) + ":\n" + reads)
+    def wait_for_ports(self, interfaces=None, timeout=600, process=None, verbose=False):
+        """
+        Wait until the node accepts connections on its ports. This is an
+        alternative to watching the log for the messages announcing them.
+          - interfaces: a list of names among 'thrift', 'binary', 'storage' and
+            'jmx'. By default, all the ones this node is configured to use.
+          - process: if provided, a RuntimeError is raised as soon as that
+            process exits with an error (as for watch_log_for).
+        A TimeoutError is raised if some ports still refuse connections after
+        timeout seconds.
+        """
+        if interfaces is None:
+            interfaces = self.__enabled_interfaces()
+        addresses = []
+        for name in interfaces:
+            if name == 'jmx':
+                addresses.append((self.address(), int(self.jmx_port)))
+            elif self.network_interfaces.get(name) is not None:
+                addresses.append(tuple(self.network_interfaces[name]))
+
+        def check_process():
+            if process and not common.is_win():
+                process.poll()
+                if process.returncode is not None and process.returncode != 0:
+                    self.print_process_output(self.name, process, verbose)
+                    raise RuntimeError() # Same as watch_log_for
 
-                if process:
-                    process.poll()
-                    if process.returncode is not None and process.returncode == 0:
-                        return None
+        missing = common.wait_for_ports(addresses, timeout, check_process)
+        if len(missing) > 0:
+            raise TimeoutError(time.strftime("%d %b %Y %H:%M:%S", time.gmtime()) + " [" + self.name + "] Not accepting connections on: " + ", ".join([ "%s:%s" % itf for itf in missing ]))
 
     def watch_log_for_death(self, nodes, from_mark=None, timeout=600):
         """
@@ -334,8 +394,7 @@ class Node():
         the log is watched from the beginning.
         """
         tofind = nodes if isinstance(nodes, list) else [nodes]
-        tofind = [ "%s is now [dead|DOWN]" % node.address() for node in tofind ]
-        self.watch_log_for(tofind, from_mark=from_mark, timeout=timeout)
+        self.__watch_log_for_addresses(tofind, "%s is now [dead|DOWN]", from_mark, timeout)
 
     def watch_log_for_alive(self, nodes, from_mark=None, timeout=120):
         """
@@ -343,8 +402,71 @@ class Node():
         nodes are marked UP. This method works similarily to watch_log_for_death.
         """
         tofind = nodes if isinstance(nodes, list) else [nodes]
-        tofind = [ "%s.* now UP" % node.address() for node in tofind ]
-        self.watch_log_for(tofind, from_mark=from_mark, timeout=timeout)
+        self.__watch_log_for_addresses(tofind, "%s.* now UP", from_mark, timeout)
+
+    def __watch_log_for_addresses(self, nodes, template, from_mark, timeout):
+        # A single pass over the log with a single expression matching all the
+        # addresses, rather than one expression per node
+        tofind = set([ node.address() for node in nodes ])
+        if len(tofind) == 0:
+            return
+        addresses = "|".join([ re.escape(a) for a in sorted(tofind, key=len, reverse=True) ])
+        pattern = re.compile(template % ("(?P<address>%s)(?![0-9])" % addresses))
+
+        def on_line(line):
+            m = pattern.search(line)
+            if m:
+                tofind.discard(m.group('address'))
+            return len(tofind) == 0
+
+        self.__watch_log(on_line, lambda: str(sorted(tofind)), from_mark, timeout)
+
+    def __watch_log(self, on_line, missing, from_mark, timeout, process=None, verbose=False):
+        # Feeds on_line with the log lines (from from_mark) until it returns
+        # True, in which case True is returned. Returns None if the process
+        # terminates cleanly first.
+        start = time.time()
+        reads = ""
+        with LogWatcher(self.logfilename()) as watcher:
+            while not os.path.exists(self.logfilename()):
+                watcher.wait(.5)
+                if process:
+                    process.poll()
+                    if process.returncode is not None:
+                        self.print_process_output(self.name, process, verbose)
+                        if process.returncode != 0:
+                            raise RuntimeError() # Shouldn't reuse RuntimeError but I'm lazy
+
+            # without mark, the log is watched from the start of its archives
+            with LogTail(self.logfilename(), from_mark, archives=from_mark is None) as tail:
+                while True:
+                    # First, if we have a process to check, then check it.
+                    # Skip on Windows - stdout/stderr is cassandra.bat
+                    if not common.is_win():
+                        if process:
+                            process.poll()
+                            if process.returncode is not None:
+                                self.print_process_output(self.name, process, verbose)
+                                if process.returncode != 0:
+                                    raise RuntimeError() # Shouldn't reuse RuntimeError but I'm lazy
+
+                    line = tail.readline().decode('utf-8', 'replace')
+                    if line:
+                        watcher.reset()
+                        reads = reads + line
+                        if on_line(line):
+                            return True
+                    else:
+                        remaining = timeout - (time.time() - start)
+                        if remaining < 0:
+                            raise TimeoutError(time.strftime("%d %b %Y %H:%M:%S", time.gmtime()) + " [" + self.name + "] Missing: " + missing() + ":\n" + reads)
+                        # wake up regularly nevertheless to check on the process
+                        watcher.wait(min(remaining, .5))
+
+                    if process:
+                        process.poll()
+                        if process.returncode is not None and process.returncode == 0:
+                            return None
 
     def start(self,
               join_ring=True,
@@ -357,7 +479,8 @@ class Node():
               jvm_args=[],
               wait_for_binary_proto=False,
               profile_options=None,
-              use_jna=False):
+              use_jna=False,
+              probe_ports=False):
         """
         Start the node. Options includes:
           - join_ring: if false, start the node with -Dcassandra.join_ring=False
@@ -367,6 +490,9 @@ class Node():
             have marked this node UP.
           - replace_token: start the node with the -Dcassandra.replace_token option.
           - replace_address: start the node with the -Dcassandra.replace_address option.
+          - probe_ports: decide when the node is ready by connecting to its ports (see
+            wait_for_ports) rather than by waiting for it to close its output or
+            watching its log.
         """
         if self.is_running():
             raise NodeError("%s is already running" % self.name)
@@ -382,7 +508,7 @@ class Node():
         cass_bin = common.join_bin(cdir, 'bin', 'cassandra')
 
         # Copy back the cassandra scripts since profiling may have modified it the previous time
-        shutil.copy(cass_bin, self.get_bin_dir())
+        common.link_or_copy(cass_bin, self.get_bin_dir(), hardlink=True)
         cass_bin = common.join_bin(self.get_path(), 'bin', 'cassandra')
 
         # If Windows, change entries in .bat file to split conf from binaries
@@ -401,7 +527,12 @@ class Node():
             pattern=r'cassandra_parms="-Dlog4j.configuration=log4j-server.properties -Dlog4j.defaultInitOverride=true'
             common.replace_in_file(cass_bin, pattern, '    ' + pattern + ' ' + cmd + '"')
 
-        os.chmod(cass_bin, os.stat(cass_bin).st_mode | stat.S_IEXEC)
+        mode = os.stat(cass_bin).st_mode
+        if not mode & stat.S_IEXEC:
+            # the mode is shared by all the links to a file: use a private copy
+            shutil.copy2(cass_bin, cass_bin + '.tmp')
+            common.replace_file(cass_bin + '.tmp', cass_bin)
+            os.chmod(cass_bin, mode | stat.S_IEXEC)
 
         env = common.make_cassandra_env(cdir, self.get_path())
         if common.is_win():
@@ -434,6 +565,9 @@ class Node():
         elif update_pid:
             if no_wait:
                 time.sleep(2) # waiting 2 seconds nevertheless to check for early errors and for the pid to be set
+            elif probe_ports:
+                self._drain_output(process, verbose)
+                self.wait_for_ports(process=process, verbose=verbose)
             else:
                 for line in process.stdout:
                     if verbose:
@@ -445,18 +579,20 @@ class Node():
                 raise NodeError("Error starting node %s" % self.name, process)
 
         if wait_other_notice:
-            for node, mark in marks:
-                node.watch_log_for_alive(self, from_mark=mark)
+            self.cluster.wait_for_convergence(marks, nodes=[ self ])
 
         if wait_for_binary_proto:
-            self.watch_log_for("Starting listening for CQL clients")
-            # we're probably fine at that point but just wait some tiny bit more because
-            # the msg is logged just before starting the binary protocol server
-            time.sleep(0.2)
+            if probe_ports:
+                self.wait_for_ports(['binary'], process=process, verbose=verbose)
+            else:
+                self.watch_log_for("Starting listening for CQL clients")
+                # we're probably fine at that point but just wait some tiny bit more because
+                # the msg is logged just before starting the binary protocol server
+                time.sleep(0.2)
 
         return process
 
-    def stop(self, wait=True, wait_other_notice=False, gently=True):
+    def stop(self, wait=True, wait_other_notice=False, gently=True, timeout=STOP_TIMEOUT):
         """
         Stop the node.
           - wait: if True (the default), wait for the Cassandra process to be
@@ -465,7 +601,14 @@ class Node():
             cluster have marked this node has dead.
           - gently: Let Cassandra clean up and shut down properly. Otherwise do
             a 'kill -9' which shuts down faster.
+          - timeout: with wait, the time (in seconds) given to the process to
+            exit before it gets killed with a 'kill -9'.
         """
+        stopped = self.__stop(wait, wait_other_notice, gently, timeout)
+        self._save_status()
+        return stopped
+
+    def __stop(self, wait, wait_other_notice, gently, timeout):
         if self.is_running():
             if wait_other_notice:
                 #tstamp = time.time()
@@ -474,20 +617,23 @@ class Node():
             if common.is_win():
                 self.stop_win(wait, wait_other_notice, gently)
             else:
-                if gently:
-                    os.kill(self.pid, signal.SIGTERM)
-                else:
-                    os.kill(self.pid, signal.SIGKILL)
+                self._signal_stop(gently)
 
             if wait_other_notice:
                 for node, mark in marks:
                     node.watch_log_for_death(self, from_mark=mark)
                     #print node.name, "has marked", self.name, "down in " + str(time.time() - tstamp) + "s"
-            else:
+            elif not wait or common.is_win():
                 time.sleep(.1)
 
+            if not wait:
+                return True
+            if not common.is_win():
+                Node._wait_for_exit([ self ], timeout)
+                return True
+
             still_running = self.is_running()
-            if still_running and wait:
+            if still_running:
                 wait_time_sec = 1
                 for i in xrange(0, 7):
                     # we'll double the wait time each try and cassandra should
@@ -502,6 +648,35 @@ class Node():
         else:
             return False
 
+    def _signal_stop(self, gently=True):
+        if gently:
+            os.kill(self.pid, signal.SIGTERM)
+        else:
+            os.kill(self.pid, signal.SIGKILL)
+
+    @staticmethod
+    def _wait_for_exit(nodes, timeout):
+        """
+        Wait for the processes of the provided (signaled) nodes to exit. The
+        ones still running after timeout seconds are killed with SIGKILL, and
+        a NodeError is raised if even that didn't get rid of them.
+        """
+        by_pid = dict([ (node.pid, node) for node in nodes if node.pid is not None ])
+        running = common.wait_for_processes_exit(list(by_pid.keys()), timeout)
+        if len(running) > 0:
+            for pid in running:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            running = common.wait_for_processes_exit(running, 10)
+
+        for node in nodes:
+            node._save_status()
+
+        if len(running) > 0:
+            raise NodeError("Problem stopping node(s) %s" % ", ".join(sorted([ by_pid[pid].name for pid in running ])))
+
     def stop_win(self, wait=True, wait_other_notice=False, gently=True):
         # Gentle on Windows is relative.  WM_CLOSE is the best we get without external scripting
         # New stop-server.bat allows for gentle shutdown on windows. If gentle shutdown
@@ -803,7 +978,7 @@ class Node():
         for name in os.listdir(conf_dir):
             filename = os.path.join(conf_dir, name)
             if os.path.isfile(filename):
-                shutil.copy(filename, self.get_conf_dir())
+                common.link_or_copy(filename, self.get_conf_dir(), common.hardlink_conf_files())
 
         self.__update_yaml()
         version = self.cluster.version()
@@ -819,7 +994,7 @@ class Node():
         for name in os.listdir(bin_dir):
             filename = os.path.join(bin_dir, name)
             if os.path.isfile(filename):
-                shutil.copy(filename, self.get_bin_dir())
+                common.link_or_copy(filename, self.get_bin_dir(), hardlink=True)
                 common.add_exec_permission(bin_dir, name)
 
     def __clean_bat(self):
@@ -862,7 +1037,6 @@ class Node():
             for dir in self.__get_diretories():
                 os.mkdir(os.path.join(dir_name, dir))
 
-        filename = os.path.join(dir_name, 'node.conf')
         values = {
             'name' : self.name,
             'status' : self.status,
@@ -873,6 +1047,8 @@ class Node():
         }
         if self.pid:
             values['pid'] = self.pid
+            if self.__pid_start_time is not None:
+                values['pid_start_time'] = self.__pid_start_time
         if self.initial_token:
             values['initial_token'] = self.initial_token
         if self.__cassandra_dir is not None:
@@ -881,13 +1057,18 @@ class Node():
             values['data_center'] = self.data_center
         if self.remote_debug_port:
             values['remote_debug_port'] = self.remote_debug_port
-        with open(filename, 'w') as f:
-            yaml.safe_dump(values, f)
+        status_changed = not (self.status, self.pid) == self.__saved_status
+        self.cluster._save_node_config(self, values, status_changed)
+        self.__saved_status = (self.status, self.pid)
 
     def __update_yaml(self):
+        # The node yaml is rendered from the (cached) yaml of the install
+        # with the node and cluster settings on top of it
         conf_file = os.path.join(self.get_conf_dir(), common.CASSANDRA_CONF)
-        with open(conf_file, 'r') as f:
-            data = yaml.load(f)
+        base_file = os.path.join(self.get_cassandra_dir(), common.CASSANDRA_CONF_DIR, common.CASSANDRA_CONF)
+        if not os.path.exists(base_file):
+            base_file = conf_file
+        data = common.get_cached_yaml(base_file)
 
         data['cluster_name'] = self.cluster.name
         data['auto_bootstrap'] = self.auto_bootstrap
@@ -922,8 +1103,9 @@ class Node():
             else:
                 data[name] = full_options[name]
 
+        common.unshare_file(conf_file)
         with open(conf_file, 'w') as f:
-            yaml.safe_dump(data, f, default_flow_style=False)
+            common.dump_yaml(data, f, default_flow_style=False)
 
     def __update_log4j(self):
         append_pattern='log4j.appender.R.File='
@@ -980,7 +1162,26 @@ class Node():
         if self.cluster.version() < '2.0.1':
             common.replace_in_file(conf_file, "-Xss", '    JVM_OPTS="$JVM_OPTS -Xss228k"')
 
-    def __update_status(self):
+    @staticmethod
+    def refresh_status(nodes):
+        """
+        Probe the status of all the provided nodes (of any cluster) with a
+        single scan of the running processes.
+        """
+        nodes = [ node for node in nodes if node.pid is not None ]
+        processes = None
+        if not common.is_win():
+            processes = common.scan_processes([ node.pid for node in nodes ])
+        for node in nodes:
+            node.__update_status(force=True, processes=processes)
+
+    def __update_status(self, force=False, processes=None):
+        # This only probes the process: the status is persisted by
+        # _save_status, when starting or stopping the node
+        now = time.time()
+        if not force and now - self.__status_time < STATUS_CACHE_TTL:
+            return
+        self.__status_time = now
         if self.pid is None:
             if self.status == Status.UP or self.status == Status.DECOMMISIONNED:
                 self.status = Status.DOWN
@@ -992,20 +1193,15 @@ class Node():
         if common.is_win():
             self.__update_status_win()
         else:
-            try:
-                os.kill(self.pid, 0)
-            except OSError as err:
-                if err.errno == errno.ESRCH:
-                    # not running
-                    if self.status == Status.UP or self.status == Status.DECOMMISIONNED:
-                        self.status = Status.DOWN
-                elif err.errno == errno.EPERM:
-                    # no permission to signal this process
-                    if self.status == Status.UP or self.status == Status.DECOMMISIONNED:
-                        self.status = Status.DOWN
-                else:
-                    # some other error
-                    raise err
+            if processes is None:
+                processes = common.scan_processes([ self.pid ])
+            if processes is None:
+                running = common.is_process_running(self.pid)
+            else:
+                running = self.__is_own_process(processes)
+            if not running:
+                if self.status == Status.UP or self.status == Status.DECOMMISIONNED:
+                    self.status = Status.DOWN
             else:
                 if self.status == Status.DOWN or self.status == Status.UNINITIALIZED:
                     self.status = Status.UP
@@ -1013,6 +1209,25 @@ class Node():
         if not old_status == self.status:
             if old_status == Status.UP and self.status == Status.DOWN:
                 self.pid = None
+                self.__pid_start_time = None
+
+    def __is_own_process(self, processes):
+        # The pid may have been reused by another process since the node
+        # was started: check it's still the one that was started
+        if self.pid not in processes:
+            return False
+        start_time, cmdline = processes[self.pid]
+        if self.__pid_start_time is not None:
+            return start_time == self.__pid_start_time
+        # started by a ccm version that didn't record the start time
+        return 'cassandra' in cmdline.lower()
+
+    def _save_status(self):
+        """
+        Probe the node status and record it in node.conf if it changed.
+        """
+        self.__update_status(force=True)
+        if not (self.status, self.pid) == self.__saved_status:
             self.__update_config()
 
     def __update_status_win(self):
@@ -1029,6 +1244,17 @@ class Node():
             if self.status == Status.DOWN or self.status == Status.UNINITIALIZED:
                 self.status = Status.UP
 
+    def __enabled_interfaces(self):
+        conf_file = os.path.join(self.get_conf_dir(), common.CASSANDRA_CONF)
+        with open(conf_file, 'r') as f:
+            data = common.load_yaml(f)
+        interfaces = [ 'storage', 'jmx' ]
+        if data.get('start_rpc', True):
+            interfaces.append('thrift')
+        if self.network_interfaces['binary'] is not None and data.get('start_native_transport', False):
+            interfaces.append('binary')
+        return interfaces
+
     def __get_diretories(self):
         dirs = {}
         for i in ['data', 'commitlogs', 'saved_caches', 'logs', 'conf', 'bin']:
@@ -1109,7 +1335,12 @@ class Node():
                     self.pid = int(f.readline().strip())
         except IOError:
             raise NodeError('Problem starting node %s' % self.name, process)
-        self.__update_status()
+        self.__pid_start_time = None
+        if not common.is_win():
+            processes = common.scan_processes([ self.pid ])
+            if processes is not None and self.pid in processes:
+                self.__pid_start_time = processes[self.pid][0]
+        self._save_status()
 
     def __gather_sstables(self, datafile=None, keyspace=None, columnfamilies=None):
         datafiles = []
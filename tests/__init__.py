@@ -10,6 +10,25 @@ if sys.version_info < (3, 0):
     FileNotFoundError = OSError
 
 
+def make_cassandra_dir(path, version="2.0.3"):
+    """
+    Create a minimal Cassandra install at path: enough to create clusters
+    and nodes, not to start them.
+    """
+    for d in [ "bin", "conf" ]:
+        os.makedirs(os.path.join(path, d))
+    for f in [ "conf/log4j-server.properties", "conf/cassandra-env.sh", "bin/cassandra.in.sh", "bin/cassandra.bat" ]:
+        open(os.path.join(path, f), "w").close()
+    with open(os.path.join(path, "conf", "cassandra.yaml"), "w") as f:
+        f.write("cluster_name: 'Test Cluster'\n"
+                "seed_provider:\n"
+                "    - class_name: org.apache.cassandra.locator.SimpleSeedProvider\n"
+                "      parameters:\n"
+                "          - seeds: \"127.0.0.1\"\n")
+    with open(os.path.join(path, "build.xml"), "w") as f:
+        f.write('<project><property name="base.version" value="%s"/></project>\n' % version)
+
+
 def setup_package():
     try:
         shutil.rmtree(TEST_DIR)
@@ -0,0 +1,134 @@
+import os
+import shutil
+import sys
+import threading
+sys.path = [".."] + sys.path
+
+from . import TEST_DIR, make_cassandra_dir
+from ccmlib import common
+from ccmlib.cluster import Cluster
+from ccmlib.node import Node, Status
+
+CONFIG_DIR = os.path.join(TEST_DIR, "concurrent")
+CASSANDRA_DIR = os.path.join(TEST_DIR, "concurrent-cassandra")
+
+# Each test loads the same cluster in several Cluster objects, as separate
+# ccm processes would, and checks that their updates don't overwrite each
+# other, with cluster.conf and node.conf files and with a state file.
+
+
+def setup_module():
+    teardown_module()
+    make_cassandra_dir(CASSANDRA_DIR)
+
+
+def teardown_module():
+    for d in [ CONFIG_DIR, CASSANDRA_DIR ]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def new_cluster(name, state_file):
+    path = os.path.join(CONFIG_DIR, name + ("-state" if state_file else ""))
+    os.makedirs(path)
+    if state_file:
+        with open(os.path.join(path, common.CONFIG_FILE), "w") as f:
+            f.write("state_file: true\n")
+    Cluster(path, "test", cassandra_dir=CASSANDRA_DIR).populate(3)
+    return path
+
+
+def saved_config(path, node_name):
+    state_file = os.path.join(path, "test", common.CLUSTER_STATE)
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            return common.load_yaml(f)["nodes"][node_name]
+    with open(os.path.join(path, "test", node_name, common.NODE_CONF)) as f:
+        return common.load_yaml(f)
+
+
+def options(path, node_name):
+    return saved_config(path, node_name)["config_options"]
+
+
+def check_different_nodes(state_file):
+    path = new_cluster("nodes", state_file)
+    first, second = Cluster.load(path, "test"), Cluster.load(path, "test")
+    first.nodes["node1"].set_configuration_options({ "concurrent_reads" : 11 })
+    second.nodes["node2"].set_configuration_options({ "concurrent_reads" : 22 })
+    assert options(path, "node1")["concurrent_reads"] == 11
+    assert options(path, "node2")["concurrent_reads"] == 22
+
+
+def check_concurrent_threads(state_file):
+    path = new_cluster("threads", state_file)
+    clusters = [ Cluster.load(path, "test") for _ in range(3) ]
+    threads = [ threading.Thread(target=clusters[i].nodes["node%d" % (i + 1)].set_configuration_options, args=({ "concurrent_reads" : i + 1 },)) for i in range(3) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(3):
+        assert options(path, "node%d" % (i + 1))["concurrent_reads"] == i + 1
+
+
+def check_add_and_remove(state_file):
+    path = new_cluster("topology", state_file)
+    adding, removing = Cluster.load(path, "test"), Cluster.load(path, "test")
+    node = Node("node4", adding, False, ("127.0.0.4", 9160), ("127.0.0.4", 7000), "7400", "0", None, binary_interface=("127.0.0.4", 9042))
+    adding.add(node, False)
+    removing.remove(removing.nodes["node3"])
+
+    cluster = Cluster.load(path, "test")
+    assert sorted(cluster.nodes.keys()) == [ "node1", "node2", "node4" ]
+    assert sorted([ seed.name for seed in cluster.seeds ]) == [ "node1", "node2" ]
+
+
+def check_status(state_file):
+    path = new_cluster("status", state_file)
+    starting, other = Cluster.load(path, "test"), Cluster.load(path, "test")
+    # the status recorded by the process that started the node...
+    node = starting.nodes["node1"]
+    node.status = Status.UP
+    node.set_configuration_options({ "concurrent_reads" : 1 })
+    # ...is kept by the updates of other processes that didn't change it
+    other.nodes["node1"].set_configuration_options({ "concurrent_writes" : 2 })
+    assert saved_config(path, "node1")["status"] == Status.UP
+    assert options(path, "node1")["concurrent_writes"] == 2
+
+    # and overwritten by the ones that did
+    node = other.nodes["node1"]
+    node.status = Status.DOWN
+    node.set_configuration_options({ "concurrent_writes" : 3 })
+    assert saved_config(path, "node1")["status"] == Status.DOWN
+
+
+def test_different_nodes():
+    check_different_nodes(False)
+
+
+def test_different_nodes_with_state_file():
+    check_different_nodes(True)
+
+
+def test_concurrent_threads():
+    check_concurrent_threads(False)
+
+
+def test_concurrent_threads_with_state_file():
+    check_concurrent_threads(True)
+
+
+def test_add_and_remove():
+    check_add_and_remove(False)
+
+
+def test_add_and_remove_with_state_file():
+    check_add_and_remove(True)
+
+
+def test_status():
+    check_status(False)
+
+
+def test_status_with_state_file():
+    check_status(True)
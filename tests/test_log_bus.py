@@ -0,0 +1,156 @@
+import os
+import shutil
+import sys
+import threading
+sys.path = [".."] + sys.path
+
+from . import TEST_DIR
+from ccmlib.log_bus import LogBus
+from ccmlib.log_watcher import file_mark
+from ccmlib.node import TimeoutError
+
+LOG_DIR = os.path.join(TEST_DIR, "bus")
+
+
+class FakeNode(object):
+    # a node with an empty log, named after the test using it
+    def __init__(self, name):
+        self.name = name
+        if os.path.exists(self.logfilename()):
+            os.remove(self.logfilename())
+
+    def logfilename(self):
+        return os.path.join(LOG_DIR, self.name + ".log")
+
+    def address(self):
+        return self.name
+
+    def log(self, *lines):
+        with open(self.logfilename(), "a") as f:
+            for line in lines:
+                f.write(line + "\n")
+
+
+def setup_module():
+    teardown_module()
+    os.makedirs(LOG_DIR)
+
+
+def teardown_module():
+    shutil.rmtree(LOG_DIR, ignore_errors=True)
+
+
+def test_subscribe():
+    node = FakeNode("subscribe")
+    node.log("Starting")
+    bus = LogBus()
+    try:
+        future = bus.subscribe(node, [ "Listening for thrift clients", "Starting listening for CQL clients" ])
+        assert not future.done()
+        node.log("Listening for thrift clients...", "Starting listening for CQL clients")
+        matchings = future.result(timeout=10)
+        assert [ line.strip() for line, _ in matchings ] == [ "Listening for thrift clients...", "Starting listening for CQL clients" ]
+    finally:
+        bus.close()
+
+
+def test_subscribe_from_mark():
+    node = FakeNode("subscribe_from_mark")
+    node.log("Compacted 1")
+    mark = file_mark(node.logfilename())
+    bus = LogBus()
+    try:
+        future = bus.subscribe(node, "Compacted", from_mark=mark)
+        node.log("Compacted 2")
+        line, _ = future.result(timeout=10)
+        assert line.strip() == "Compacted 2"
+    finally:
+        bus.close()
+
+
+def test_catch_up():
+    node = FakeNode("catch_up")
+    node.log("Line 1", "Line 2")
+    bus = LogBus()
+    try:
+        bus.subscribe(node, "Line 2").result(timeout=10)
+        # the reader is past that line already
+        line, _ = bus.subscribe(node, "Line 1").result(timeout=10)
+        assert line.strip() == "Line 1"
+    finally:
+        bus.close()
+
+
+def test_timeout():
+    node = FakeNode("timeout")
+    node.log("Starting")
+    bus = LogBus()
+    try:
+        future = bus.subscribe(node, "never logged")
+        try:
+            future.result(timeout=0.2)
+            assert False, "expected a TimeoutError"
+        except TimeoutError as e:
+            assert "never logged" in str(e)
+    finally:
+        bus.close()
+
+
+def test_callback_subscribing_again():
+    node = FakeNode("callback_subscribing_again")
+    bus = LogBus()
+    done = threading.Event()
+    results = []
+
+    def on_first(result):
+        results.append(result[0].strip())
+        bus.subscribe(node, "Second", callback=on_second)
+
+    def on_second(result):
+        results.append(result[0].strip())
+        done.set()
+
+    try:
+        node.log("Starting")
+        bus.subscribe(node, "First", callback=on_first)
+        node.log("First", "Second")
+        assert done.wait(10)
+        assert results == [ "First", "Second" ]
+    finally:
+        bus.close()
+
+
+def test_callback_on_catch_up():
+    node = FakeNode("callback_on_catch_up")
+    node.log("Line 1", "Line 2")
+    bus = LogBus()
+    results = []
+    try:
+        bus.subscribe(node, "Line 2").result(timeout=10)
+        future = bus.subscribe(node, "Line 1", callback=lambda result: results.append(bus.subscribe(node, "Line 2")))
+        future.result(timeout=10)
+        assert len(results) == 1
+        assert results[0].result(timeout=10)[0].strip() == "Line 2"
+    finally:
+        bus.close()
+
+
+def test_subscribe_addresses():
+    node = FakeNode("subscribe_addresses")
+    others = [ FakeNode("127.0.0.2"), FakeNode("127.0.0.20"), FakeNode("127.0.0.3") ]
+    bus = LogBus()
+    try:
+        future = bus.subscribe_addresses(node, "%s.* now UP", others)
+        node.log("InetAddress /127.0.0.20 is now UP", "InetAddress /127.0.0.3 is now UP")
+        # once the reader is past those lines, only 127.0.0.2 is missing
+        bus.subscribe(node, "127.0.0.3 is now UP").result(timeout=10)
+        try:
+            future.result(timeout=0.2)
+            assert False, "expected a TimeoutError"
+        except TimeoutError as e:
+            assert "['127.0.0.2']" in str(e)
+        node.log("InetAddress /127.0.0.2 is now UP")
+        matchings = future.result(timeout=10)
+        assert sorted([ m.group('address') for _, m in matchings ]) == [ "127.0.0.2", "127.0.0.20", "127.0.0.3" ]
+    finally:
+        bus.close()
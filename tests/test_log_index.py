@@ -0,0 +1,53 @@
+import os
+import shutil
+import sys
+sys.path = [".."] + sys.path
+
+from . import TEST_DIR
+from ccmlib.log_index import INDEX_INTERVAL, LogIndex
+
+LOG_DIR = os.path.join(TEST_DIR, "index")
+LOG = os.path.join(LOG_DIR, "system.log")
+
+
+def setup_module():
+    teardown_module()
+    os.makedirs(LOG_DIR)
+
+
+def teardown_module():
+    shutil.rmtree(LOG_DIR, ignore_errors=True)
+
+
+def write_log(f, hour, count):
+    # count lines of about 240 bytes, a second apart
+    line = "INFO  [main] 2014-01-21 %02d:%02d:%02d,000 " + "x" * 200 + "\n"
+    for i in range(count):
+        f.write((line % (hour, i // 60 % 60, i % 60)).encode("ascii"))
+
+
+def test_offset():
+    with open(LOG, "wb") as f:
+        write_log(f, 10, 4 * INDEX_INTERVAL // 240)
+    index = LogIndex(LOG)
+    offset = index.offset("2014-01-21 10:30:00")
+    with open(LOG, "rb") as f:
+        f.seek(offset)
+        assert f.readline().startswith(b"INFO  [main] 2014-01-21 10:30:00,000")
+    # from the saved index
+    assert LogIndex(LOG).offset("2014-01-21 10:30:00") == offset
+
+
+def test_log_recreated_with_same_inode():
+    with open(LOG, "wb") as f:
+        write_log(f, 10, 4 * INDEX_INTERVAL // 240)
+    inode = os.stat(LOG).st_ino
+    LogIndex(LOG).offset("2014-01-21 10:00:00")
+
+    # a longer log of later lines in the same inode, as after a logback
+    # rotation reusing the inode of the old log
+    with open(LOG, "r+b") as f:
+        f.truncate(0)
+        write_log(f, 11, 5 * INDEX_INTERVAL // 240)
+    assert os.stat(LOG).st_ino == inode
+    assert LogIndex(LOG).offset("2014-01-21 11:00:00") == 0
@@ -0,0 +1,90 @@
+import os
+import shutil
+import sys
+import zipfile
+sys.path = [".."] + sys.path
+
+from . import TEST_DIR
+from ccmlib.log_watcher import LogTail, file_mark
+
+LOG_DIR = os.path.join(TEST_DIR, "rotation")
+LOG = os.path.join(LOG_DIR, "system.log")
+
+
+def teardown_module():
+    shutil.rmtree(LOG_DIR, ignore_errors=True)
+
+
+def new_log(*lines):
+    # a log of lines, without archives
+    shutil.rmtree(LOG_DIR, ignore_errors=True)
+    os.makedirs(LOG_DIR)
+    with open(LOG, "wb") as f:
+        f.writelines(lines)
+
+
+def log_lines(first, last):
+    return [ ("INFO  [main] 2014-01-21 11:15:%02d,000 Line %d\n" % (i, i)).encode("ascii") for i in range(first, last) ]
+
+
+def read_all(tail):
+    lines = []
+    while True:
+        line = tail.readline()
+        if not line:
+            return lines
+        lines.append(line)
+
+
+def rotate_to_zip(recreate):
+    # what logback does: compress the log into the newest archive, delete
+    # the log and create the new one
+    with zipfile.ZipFile(LOG + ".1.zip", "w") as archive:
+        archive.write(LOG, "system.log")
+    recreate()
+
+
+def test_mark_after_zip_rotation_reusing_inode():
+    new_log(*log_lines(0, 10))
+    mark = file_mark(LOG)
+    with open(LOG, "ab") as f:
+        f.writelines(log_lines(10, 12))
+
+    def recreate():
+        # The filesystem may or may not hand the inode of the deleted log to
+        # the new one, so reuse it for sure by rewriting the log in place
+        with open(LOG, "r+b") as f:
+            f.truncate(0)
+            f.writelines(log_lines(12, 14))
+    rotate_to_zip(recreate)
+    assert file_mark(LOG).inode == mark.inode
+
+    with LogTail(LOG, mark) as tail:
+        assert read_all(tail) == log_lines(10, 14)
+
+
+def test_mark_after_zip_rotation_new_inode():
+    new_log(*log_lines(0, 10))
+    mark = file_mark(LOG)
+    with open(LOG, "ab") as f:
+        f.writelines(log_lines(10, 12))
+
+    def recreate():
+        os.remove(LOG)
+        with open(LOG, "wb") as f:
+            f.writelines(log_lines(12, 14))
+    rotate_to_zip(recreate)
+
+    with LogTail(LOG, mark) as tail:
+        assert read_all(tail) == log_lines(10, 14)
+
+
+def test_mark_without_rotation():
+    new_log(*log_lines(0, 10))
+    mark = file_mark(LOG)
+    with open(LOG, "ab") as f:
+        f.writelines(log_lines(10, 12))
+
+    with LogTail(LOG, mark) as tail:
+        assert read_all(tail) == log_lines(10, 12)
+        assert tail.mark().same_file(mark)
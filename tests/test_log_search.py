@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import io
+import re
+import sys
+sys.path = [".."] + sys.path
+
+from ccmlib.log_search import grep_buffer, grep_stream
+
+LOG = (u"INFO  [main] 2014-01-21 11:15:36,545 Keyspace café created\n"
+       u"INFO  [main] 2014-01-21 11:15:37,545 Keyspace system created\n"
+       u"INFO  [main] 2014-01-21 11:15:38,545 User ÉMILE logged in\n"
+       u"INFO  [main] 2014-01-21 11:15:39,545 Separator\x1c created\n").encode("utf-8")
+
+
+def baseline(expr):
+    pattern = re.compile(expr)
+    lines = [ line + u"\n" for line in LOG.decode("utf-8").split(u"\n")[:-1] ]
+    return [ line for line in lines if pattern.search(line) ]
+
+
+def check(expr):
+    expected = baseline(expr)
+    assert [ line for line, _ in grep_buffer(LOG, re.compile(expr)) ] == expected
+    assert [ line for line, _ in grep_stream(io.BytesIO(LOG), re.compile(expr)) ] == expected
+    return expected
+
+
+def test_non_ascii_lines():
+    assert len(check(u"caf. created")) == 1
+    assert len(check(u"\\w+ created")) == 2
+    assert len(check(u"(?i)émile")) == 1
+    assert len(check(u"[^a-z ]+ logged")) == 1
+
+
+def test_unicode_whitespace():
+    assert len(check(u"Separator\\s")) == 1
+
+
+def test_ascii_lines():
+    log = "".join([ "INFO  [main] 2014-01-21 11:15:36,545 Line %d\n" % i for i in range(100) ]).encode("ascii")
+    matches = [ line for line, _ in grep_buffer(log, re.compile(u"(?i)line \\d*7$")) ]
+    assert matches == [ u"INFO  [main] 2014-01-21 11:15:36,545 Line %d\n" % i for i in range(100) if i % 10 == 7 ]
+
+
+def test_line_bounds():
+    log = b"INFO a\nERROR b\nERROR c\n"
+    for expr in [ u"\\AERROR", u"c\\n\\Z", u"(?<!\\n)ERROR", u"(?<![a-z])ERROR" ]:
+        expected = [ line for line in [ u"INFO a\n", u"ERROR b\n", u"ERROR c\n" ] if re.search(expr, line) ]
+        assert len(expected) > 0
+        assert [ line for line, _ in grep_buffer(log, re.compile(expr)) ] == expected
+        assert [ line for line, _ in grep_stream(io.BytesIO(log), re.compile(expr)) ] == expected
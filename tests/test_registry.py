@@ -0,0 +1,60 @@
+import os
+import shutil
+import sys
+sys.path = [".."] + sys.path
+
+from six import StringIO
+
+from . import TEST_DIR, make_cassandra_dir
+from ccmlib import common
+from ccmlib.cluster import Cluster
+from ccmlib.cmds.dispatch import get_command
+
+CONFIG_DIR = os.path.join(TEST_DIR, "registry")
+CASSANDRA_DIR = os.path.join(TEST_DIR, "registry-cassandra")
+
+
+def setup_module():
+    teardown_module()
+    make_cassandra_dir(CASSANDRA_DIR)
+    os.makedirs(CONFIG_DIR)
+
+
+def teardown_module():
+    for d in [ CONFIG_DIR, CASSANDRA_DIR ]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def ccm_list(*args):
+    cmd = get_command("cluster", "list")
+    parser = cmd.get_parser()
+    (options, args) = parser.parse_args(list(args) + [ "--config-dir", CONFIG_DIR ])
+    cmd.validate(parser, options, args)
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        cmd.run()
+        return sys.stdout.getvalue().split()
+    finally:
+        sys.stdout = stdout
+
+
+def test_registry():
+    Cluster(CONFIG_DIR, "before", cassandra_dir=CASSANDRA_DIR).populate(1)
+    # builds the registry
+    assert ccm_list() == [ "before" ]
+    assert sorted(common.load_registry(CONFIG_DIR).keys()) == [ "before" ]
+
+    cluster = Cluster(CONFIG_DIR, "test", cassandra_dir=CASSANDRA_DIR).populate(3)
+    assert sorted(common.load_registry(CONFIG_DIR)["test"]["nodes"].keys()) == [ "node1", "node2", "node3" ]
+    assert ccm_list() == [ "before", "test" ]
+
+    cluster.remove(cluster.nodes["node3"])
+    assert sorted(common.load_registry(CONFIG_DIR)["test"]["nodes"].keys()) == [ "node1", "node2" ]
+
+    # removed by hand
+    shutil.rmtree(os.path.join(CONFIG_DIR, "before"))
+    assert ccm_list() == [ "test" ]
+    assert sorted(common.load_registry(CONFIG_DIR).keys()) == [ "test" ]
+
+    cluster.remove()
+    assert ccm_list() == []
@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+sys.path = [".."] + sys.path
+
+from . import TEST_DIR, make_cassandra_dir
+from ccmlib.cluster import Cluster
+
+CONFIG_DIR = os.path.join(TEST_DIR, "startup")
+CCM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ccm")
+
+# Upper bound (in seconds) of a ccm run: only meant to catch gross regressions,
+# as the time it takes depends on the machine and its load
+STARTUP_TIME_LIMIT = float(os.environ.get("CCM_STARTUP_TIME_LIMIT", 10))
+
+# modules only some commands need, that must not slow the others down
+HEAVY_MODULES = [ "ccmlib.repository", "ccmlib.bulkloader", "tarfile", "urllib.request", "urllib2", "ctypes" ]
+
+# runs the ccm script and reports the modules it imported on stderr
+RUNNER = """
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write('\\nmodules: ' + ' '.join(sorted(sys.modules)))
+"""
+
+
+CASSANDRA_DIR = os.path.join(TEST_DIR, "startup-cassandra")
+
+
+def setup_module():
+    teardown_module()
+    make_cassandra_dir(CASSANDRA_DIR)
+    os.makedirs(CONFIG_DIR)
+    cluster = Cluster(CONFIG_DIR, "startup", cassandra_dir=CASSANDRA_DIR)
+    cluster.populate(3)
+    run_ccm("switch", "startup")
+
+
+def teardown_module():
+    for d in [ CONFIG_DIR, CASSANDRA_DIR ]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def run_ccm(*args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(CCM) + os.pathsep + env.get("PYTHONPATH", "")
+    start = time.time()
+    process = subprocess.Popen([ sys.executable, "-c", RUNNER, CCM ] + list(args) + [ "--config-dir", CONFIG_DIR ],
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    elapsed = time.time() - start
+    assert process.returncode == 0, err
+    modules = err.decode("utf-8").rsplit("modules: ", 1)[1].split()
+    return elapsed, modules
+
+
+def check_startup(*args):
+    elapsed, modules = run_ccm(*args)
+    imported = [ m for m in HEAVY_MODULES if m in modules ]
+    assert imported == [], "ccm %s imported %s" % (" ".join(args), ", ".join(imported))
+    assert elapsed < STARTUP_TIME_LIMIT, "ccm %s took %.2fs" % (" ".join(args), elapsed)
+
+
+def test_status_startup():
+    check_startup("status")
+
+
+def test_list_startup():
+    check_startup("list")
@@ -0,0 +1,120 @@
+import os
+import shutil
+import sys
+import threading
+sys.path = [".."] + sys.path
+
+from . import TEST_DIR, make_cassandra_dir
+from ccmlib import common
+from ccmlib.cluster import Cluster
+from ccmlib.node import Status
+
+CONFIG_DIR = os.path.join(TEST_DIR, "state")
+CASSANDRA_DIR = os.path.join(TEST_DIR, "state-cassandra")
+
+
+def setup_module():
+    teardown_module()
+    make_cassandra_dir(CASSANDRA_DIR)
+
+
+def teardown_module():
+    for d in [ CONFIG_DIR, CASSANDRA_DIR ]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def new_cluster(name, state_file=False):
+    # each test has its own config directory
+    path = os.path.join(CONFIG_DIR, name)
+    os.makedirs(path)
+    if state_file:
+        enable_state_file(path)
+    Cluster(path, "test", cassandra_dir=CASSANDRA_DIR).populate(3)
+    return path
+
+
+def enable_state_file(path):
+    with open(os.path.join(path, common.CONFIG_FILE), "w") as f:
+        f.write("state_file: true\n")
+    common._state_file_settings.pop(os.path.abspath(path), None)
+
+
+def read_state(path):
+    with open(os.path.join(path, "test", common.CLUSTER_STATE)) as f:
+        return common.load_yaml(f)
+
+
+def old_files(path):
+    files = [ os.path.join(path, "test", common.CLUSTER_CONF) ]
+    files += [ os.path.join(path, "test", name, common.NODE_CONF) for name in [ "node1", "node2", "node3" ] ]
+    return [ f for f in files if os.path.exists(f) ]
+
+
+def test_migration():
+    path = new_cluster("migration")
+    assert len(old_files(path)) == 4
+    enable_state_file(path)
+
+    cluster = Cluster.load(path, "test")
+    assert old_files(path) == []
+    state = read_state(path)
+    assert state['cluster']['nodes'] == [ "node1", "node2", "node3" ]
+    assert sorted(state['nodes'].keys()) == [ "node1", "node2", "node3" ]
+    assert sorted(Cluster.load(path, "test").nodes.keys()) == sorted(cluster.nodes.keys())
+
+
+def test_write_after_migration():
+    path = new_cluster("stale")
+    stale = Cluster.load(path, "test")
+    enable_state_file(path)
+    Cluster.load(path, "test")
+
+    # loaded before the migration: the update goes to the state file
+    stale.nodes["node2"].set_configuration_options({ "concurrent_reads" : 7 })
+    assert old_files(path) == []
+    assert read_state(path)['nodes']['node2']['config_options']['concurrent_reads'] == 7
+
+
+def test_concurrent_migrations():
+    path = new_cluster("concurrent")
+    enable_state_file(path)
+    errors = []
+
+    def load():
+        try:
+            Cluster.load(path, "test")
+        except Exception as e:
+            errors.append(e)
+    threads = [ threading.Thread(target=load) for _ in range(4) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert old_files(path) == []
+    assert sorted(read_state(path)['nodes'].keys()) == [ "node1", "node2", "node3" ]
+
+
+def check_node_removal(path):
+    cluster = Cluster.load(path, "test")
+    node = cluster.nodes["node3"]
+    # the recorded status is out of date: stopping the node saves it
+    node.status = Status.UP
+    cluster.remove(node)
+
+    cluster = Cluster.load(path, "test")
+    assert sorted(cluster.nodes.keys()) == [ "node1", "node2" ]
+    assert not os.path.exists(os.path.join(path, "test", "node3"))
+    return cluster
+
+
+def test_node_removal():
+    check_node_removal(new_cluster("remove"))
+
+
+def test_node_removal_with_state_file():
+    path = new_cluster("remove-state", state_file=True)
+    check_node_removal(path)
+    state = read_state(path)
+    assert state['cluster']['nodes'] == [ "node1", "node2" ]
+    assert sorted(state['nodes'].keys()) == [ "node1", "node2" ]